@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Benchmark of the OTA pipeline against a local stand-in for ota.waydro.id.
+
+Synthetic system and vendor images (partly zero filled, like the real ones)
+are zipped and served with channel JSON files from a local HTTP server. The
+scenarios drive helpers.http.download, helpers.images.get and
+helpers.images.replace end to end, and report throughput, peak RSS and
+peak disk usage of the work directory. Every scenario checks its result,
+so a broken download path fails the run.
+
+Usage: python3 benchmarks/ota.py [--size MB] [--json] [scenario ...]
+
+Nothing of an existing installation is touched, everything happens in a
+temporary directory.
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tools.config  # noqa: E402
+from tools import helpers  # noqa: E402
+
+MB = 1000 * 1000
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """ Static files with Range and ETag support, and knobs to misbehave. """
+    # Bytes per second per connection, 0 for unlimited
+    rate = 0
+    # Close the connection after this many bytes of a response ...
+    cut_after = 0
+    # ... for this many responses, shared by all handler threads
+    cuts = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        etag = '"{}-{}"'.format(size, int(os.path.getmtime(path)))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and size:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        limit = end - start + 1
+        if self.cut_after and self.cuts and self.cuts.acquire(blocking=False):
+            limit = min(limit, self.cut_after)
+        with open(path, "rb") as f:
+            f.seek(start)
+            sent = 0
+            while sent < limit:
+                data = f.read(min(64 * 1024, limit - sent))
+                if not data:
+                    break
+                began = time.monotonic()
+                self.wfile.write(data)
+                sent += len(data)
+                if self.rate:
+                    time.sleep(max(0, len(data) / self.rate - (time.monotonic() - began)))
+
+
+def serve(root, **knobs):
+    handler = type("Handler", (Handler,), knobs)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                             functools.partial(handler, directory=root))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+
+def make_image(path, size, seed):
+    """ Write an image of size bytes where about 60% of the MiB blocks are
+        zeros and the rest are random. """
+    rng = random.Random(seed)
+    block = 1024 * 1024
+    with open(path, "wb") as f:
+        for offset in range(0, size, block):
+            length = min(block, size - offset)
+            f.write(rng.randbytes(length) if rng.random() < 0.4 else bytes(length))
+
+
+def make_channels(root, size):
+    """ Create the images, zips and channel files of a system and a vendor
+        channel in root.
+
+        :returns: dict of channel to (zip path, image path, build entry) """
+    builds = {}
+    for seed, (channel, image_size) in enumerate([("system", size), ("vendor", size // 4)]):
+        image = os.path.join(root, channel + ".img")
+        make_image(image, image_size, seed)
+        name = "{}-{}.zip".format(channel, seed + 1)
+        path = os.path.join(root, name)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zip_file:
+            zip_file.write(image, channel + ".img")
+        with open(path, "rb") as f:
+            sha256 = helpers.images.sha256sum(f)
+        build = {"datetime": seed + 1, "filename": name, "id": sha256, "url": None}
+        builds[channel] = (path, image, build)
+    return builds
+
+
+def configure(args, root, base, builds):
+    """ Point the channel files at the server on base, and the config at
+        the channel files. """
+    for channel, (path, image, build) in builds.items():
+        build["url"] = base + "/" + os.path.basename(path)
+        with open(os.path.join(root, channel + ".json"), "w") as f:
+            json.dump({"response": [build]}, f)
+    cfg = tools.config.load(args)
+    cfg["waydroid"]["images_path"] = args.images_path
+    cfg["waydroid"]["system_ota"] = base + "/system.json"
+    cfg["waydroid"]["vendor_ota"] = base + "/vendor.json"
+    tools.config.save(args, cfg)
+
+
+class DiskSampler:
+    """ Track the peak disk usage of a directory tree in a thread. """
+
+    def __init__(self, path):
+        self.path = path
+        self.peak = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def usage(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def run(self):
+        while not self.stop.wait(0.05):
+            self.peak = max(self.peak, self.usage())
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.usage())
+        return self.peak
+
+
+def make_args(work):
+    """ The subset of the waydroid args the OTA code needs, with all state
+        in work. """
+    args = types.SimpleNamespace(work=work, config=work + "/waydroid.cfg",
+                                 images_path=work + "/images", log=work + "/waydroid.log",
+                                 sudo_timer=False, timeout=1800, details_to_stdout=False,
+                                 quiet=True, verbose=False, offline=False, cache={})
+    os.makedirs(args.images_path)
+    # Keep slot switches away from the overlays of a real installation
+    for key in ["overlay", "overlay_rw", "overlay_work", "rootfs"]:
+        tools.config.defaults[key] = os.path.join(work, key)
+    return args
+
+
+def check_images(args, builds):
+    for channel, (_, image, _) in builds.items():
+        with open(image, "rb") as f:
+            expected = helpers.images.sha256sum(f)
+        with open(os.path.join(helpers.images.slot_dir(args.images_path), channel + ".img"), "rb") as f:
+            if helpers.images.sha256sum(f) != expected:
+                raise AssertionError(channel + ".img differs from the served image")
+
+
+#
+# Scenarios: each gets (args, builds, root) with a fresh work directory,
+# starts its own server when it needs special behaviour, and returns
+# (bytes processed, seconds)
+#
+
+def scenario_download(args, builds, root, **knobs):
+    server, base = serve(root, **knobs)
+    path, _, build = builds["system"]
+    digest = hashlib.sha256()
+    start = time.monotonic()
+    result = helpers.http.download(args, base + "/" + build["filename"], "bench", digest=digest)
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    if digest.hexdigest() != build["id"]:
+        raise AssertionError("Downloaded zip hash mismatch")
+    return os.path.getsize(result), elapsed
+
+
+def scenario_hash(args, builds, root):
+    path, _, build = builds["system"]
+    start = time.monotonic()
+    with open(path, "rb") as f:
+        sha256 = helpers.images.sha256sum(f)
+    elapsed = time.monotonic() - start
+    if sha256 != build["id"]:
+        raise AssertionError("Hash mismatch")
+    return os.path.getsize(path), elapsed
+
+
+def scenario_extract(args, builds, root):
+    path, image, _ = builds["system"]
+    stream = helpers.images.ZipStream(args.images_path)
+    start = time.monotonic()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(helpers.http.chunk_size), b""):
+            stream.update(data)
+    if stream.failed:
+        raise AssertionError("Streaming extraction failed: " + stream.failed)
+    stream.commit()
+    elapsed = time.monotonic() - start
+    return os.path.getsize(image), elapsed
+
+
+def scenario_get(args, builds, root):
+    server, base = serve(root)
+    configure(args, root, base, builds)
+    start = time.monotonic()
+    helpers.images.get(args)
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    check_images(args, builds)
+    return sum(os.path.getsize(path) for path, _, _ in builds.values()), elapsed
+
+
+def scenario_replace(args, builds, root):
+    server, base = serve(root)
+    configure(args, root, base, builds)
+    zips = {}
+    for channel, (path, _, _) in builds.items():
+        zips[channel] = os.path.join(args.work, os.path.basename(path))
+        shutil.copyfile(path, zips[channel])
+    start = time.monotonic()
+    helpers.images.replace(args, zips["system"], builds["system"][2]["datetime"],
+                           zips["vendor"], builds["vendor"][2]["datetime"])
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    check_images(args, builds)
+    return sum(os.path.getsize(path) for path, _, _ in builds.values()), elapsed
+
+
+def scenario_throttled(args, builds, root):
+    # 4 MB/s per connection, well below what loopback and disk can do
+    return scenario_download(args, builds, root, rate=4 * MB)
+
+
+def scenario_disconnect(args, builds, root):
+    # The first 6 responses break off after 1 MiB
+    return scenario_download(args, builds, root, cut_after=1024 * 1024,
+                             cuts=threading.Semaphore(6))
+
+
+def scenario_404(args, builds, root):
+    server, base = serve(root)
+    start = time.monotonic()
+    if helpers.http.download(args, base + "/missing.zip", "bench", allow_404=True) is not None:
+        raise AssertionError("Download of a missing file didn't return None")
+    configure(args, root, base, builds)
+    with open(os.path.join(root, "system.json")) as f:
+        channel = json.load(f)
+    channel["response"][0]["url"] = base + "/missing.zip"
+    with open(os.path.join(root, "system.json"), "w") as f:
+        json.dump(channel, f)
+    try:
+        helpers.images.get(args)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("images.get() succeeded with a missing zip")
+    finally:
+        server.shutdown()
+    elapsed = time.monotonic() - start
+    for _, _, filenames in os.walk(args.images_path):
+        if any(name.endswith(".new") for name in filenames):
+            raise AssertionError("A failed update left staged files behind")
+    return 0, elapsed
+
+
+scenarios = {
+    "download": scenario_download,
+    "hash": scenario_hash,
+    "extract": scenario_extract,
+    "get": scenario_get,
+    "replace": scenario_replace,
+    "throttled": scenario_throttled,
+    "disconnect": scenario_disconnect,
+    "404": scenario_404,
+}
+
+
+def run(name, root, builds, queue):
+    """ Run a scenario in a child process, so its peak RSS is its own. """
+    work = tempfile.mkdtemp(prefix="waydroid-bench-")
+    # Keep the download progress out of the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    try:
+        args = make_args(work)
+        helpers.logging.add_verbose_log_level()
+        sampler = DiskSampler(work)
+        error = None
+        try:
+            processed, elapsed = scenarios[name](args, builds, root)
+        except Exception as e:
+            processed, elapsed, error = 0, 0, "{}: {}".format(type(e).__name__, e)
+        disk = sampler.finish()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        queue.put({"scenario": name, "mb": processed / MB, "seconds": elapsed,
+                   "mb_per_s": processed / MB / elapsed if processed and elapsed else None,
+                   "peak_rss_mb": rss / MB, "peak_disk_mb": disk / MB, "error": error})
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OTA pipeline against a local server")
+    parser.add_argument("--size", type=int, default=256,
+                        help="size of the system image in MB, the vendor image is a quarter")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("scenario", nargs="*",
+                        help="scenarios to run: {} (default: all)".format(", ".join(scenarios)))
+    bench_args = parser.parse_args()
+    for name in bench_args.scenario:
+        if name not in scenarios:
+            parser.error("unknown scenario: " + name)
+
+    root = tempfile.mkdtemp(prefix="waydroid-bench-ota-")
+    try:
+        builds = make_channels(root, bench_args.size * MB)
+        results = []
+        context = multiprocessing.get_context("fork")
+        for name in bench_args.scenario or list(scenarios):
+            queue = context.Queue()
+            process = context.Process(target=run, args=(name, root, builds, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            results.append(result)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if bench_args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<12}{:>10}{:>10}{:>10}{:>12}{:>12}  {}".format(
+            "scenario", "MB", "seconds", "MB/s", "RSS MB", "disk MB", "result"))
+        for r in results:
+            print("{:<12}{:>10.1f}{:>10.2f}{:>10}{:>12.1f}{:>12.1f}  {}".format(
+                r["scenario"], r["mb"], r["seconds"],
+                "{:.1f}".format(r["mb_per_s"]) if r["mb_per_s"] else "-",
+                r["peak_rss_mb"], r["peak_disk_mb"], r["error"] or "ok"))
+    return 1 if any(r["error"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -50,7 +50,7 @@ def main():
             args.action = "first-launch"
 
         if not actions.initializer.is_initialized(args) and \
-                args.action not in ("init", "container", "first-launch", "log", "bugreport"):
+                args.action not in ("init", "container", "first-launch", "log", "bugreport", "cache"):
             print('Waydroid is not initialized, run "waydroid init"')
             return 0
 
@@ -138,6 +138,17 @@ def main():
                     args, ["tail", "-n", args.lines, "-F", args.log], output="tui")
             except KeyboardInterrupt:
                 pass
+        elif args.action == "cache":
+            if args.subaction in ("list", None):
+                actions.cache_manager.print_cache(args)
+            else:
+                actionNeedRoot(args.action)
+                if args.subaction == "prune":
+                    actions.cache_manager.prune(args)
+                elif args.subaction == "verify":
+                    actions.cache_manager.verify(args)
+                elif args.subaction == "clear":
+                    actions.cache_manager.clear(args)
         elif args.action == "bugreport":
             actions.bugreport(args)
         else:
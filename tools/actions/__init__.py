@@ -8,3 +8,4 @@ from tools.actions.app_manager import install, remove, launch, list
 from tools.actions.status import print_status
 from tools.actions.prop import get, set
 from tools.actions.bugreport import bugreport
+from tools.actions.cache_manager import print_cache
@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+import logging
+import os
+import shutil
+import time
+from tools import helpers
+
+def cache_dir(args):
+    return args.work + "/cache_http"
+
+def print_cache(args):
+    limit = helpers.http.cache_limit(args)
+    total = 0
+    if os.path.isdir(cache_dir(args)):
+        # Read the index without locking it, so this works without root
+        try:
+            with open(cache_dir(args) + "/index.json") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        entries = sorted(index.values(), key=lambda entry: entry["accessed"], reverse=True)
+        for entry in entries:
+            total += entry["size"]
+            print("{}\t{} MB\t{}".format(
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["accessed"])),
+                round(entry["size"] / 1000000), entry["url"]))
+        partial = [name for name in os.listdir(cache_dir(args)) if name.endswith(".part")]
+        for name in partial:
+            print("interrupted\t{} MB\t{}".format(
+                round(os.path.getsize(cache_dir(args) + "/" + name) / 1000000), name[:-5]))
+    print("Total:\t{} MB, limit: {}".format(
+        round(total / 1000000), "{} MB".format(round(limit / 1000000)) if limit else "none, files are removed after use"))
+
+def prune(args):
+    """ Evict the least recently used files down to the configured limit. """
+    freed = helpers.http.cache_evict(args, helpers.http.cache_limit(args))
+    logging.info("Freed {} MB".format(round(freed / 1000000)))
+
+def verify(args):
+    """ Re-check the hash of every cached file and remove corrupt ones. """
+    with helpers.http.cache_index(args) as index:
+        for name, entry in list(index.items()):
+            path = cache_dir(args) + "/" + name
+            with open(path, "rb") as f:
+                sha256 = helpers.images.sha256sum(f)
+            if entry.get("sha256") and sha256 != entry["sha256"]:
+                logging.warning("Removing corrupt " + entry["url"])
+                os.remove(path)
+                del index[name]
+
+def clear(args):
+    """ Remove all cached files, including interrupted downloads. """
+    if os.path.isdir(cache_dir(args)):
+        shutil.rmtree(cache_dir(args))
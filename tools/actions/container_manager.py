@@ -1,10 +1,13 @@
 # Copyright 2021 Erfan Abdi
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import copy
 import logging
 import os
 import glob
 import signal
+import threading
+import time
 import tools.config
 from contextlib import suppress
 from shutil import which
@@ -39,6 +42,14 @@ class DbusContainerManager(dbus.service.Object):
     def Stop(self, quit_session):
         stop(self.args, quit_session)
 
+    # Stop for the end of a session: the rootfs can stay mounted for the next
+    # one, or is detached lazily. Init and upgrade use Stop, since they
+    # change the images and the overlay afterwards.
+    @helpers.logging.log_exceptions
+    @dbus.service.method("id.waydro.ContainerManager", in_signature='b', out_signature='')
+    def StopSession(self, quit_session):
+        stop(self.args, quit_session, keep_rootfs=True, detach=True)
+
     @helpers.logging.log_exceptions
     @dbus.service.method("id.waydro.ContainerManager", in_signature='', out_signature='')
     def Freeze(self):
@@ -104,6 +115,36 @@ def set_permissions(args, perm_list=None, mode="777"):
     for path in perm_list:
         chmod(path, mode)
 
+prestage_thread = None
+def prestage(args):
+    """
+    Download and verify new images into the inactive slot in the background,
+    so that a later upgrade only has to switch slots and restart Android.
+    """
+    global prestage_thread
+    if prestage_thread and prestage_thread.is_alive():
+        return True
+    if not actions.initializer.is_initialized(args):
+        return True
+    cfg = tools.config.load(args)
+    if cfg["waydroid"]["images_path"] in tools.config.defaults["preinstalled_images_paths"]:
+        return True
+
+    def worker():
+        try:
+            staging_args = copy.copy(args)
+            staging_args.images_path = cfg["waydroid"]["images_path"]
+            with helpers.sched.background(args):
+                slot = helpers.images.get(staging_args, activate=False)
+            if slot:
+                logging.info("New images are staged in {}, run 'waydroid upgrade' to apply them".format(slot))
+        except Exception as e:
+            logging.warning("Failed to pre-stage images: {}".format(e))
+
+    prestage_thread = threading.Thread(target=worker, daemon=True)
+    prestage_thread.start()
+    return True
+
 def start(args):
     mainloop = GLib.MainLoop()
 
@@ -124,6 +165,12 @@ def start(args):
         logging.error("Container service is already running")
         return
 
+    interval = int(float(tools.config.load(args)["waydroid"]["prestage_interval"]) * 3600)
+    if interval > 0:
+        # First check a few minutes after boot, then on every interval
+        GLib.timeout_add_seconds(min(300, interval), lambda: prestage(args) and False)
+        GLib.timeout_add_seconds(interval, prestage, args)
+
     mainloop.run()
 
     if initializer.worker_thread is not None:
@@ -220,7 +267,14 @@ def do_start(args, session):
 
     args.session = session
 
-def stop(args, quit_session=True):
+def stop(args, quit_session=True, keep_rootfs=False, detach=False):
+    """
+    :param keep_rootfs: leave the rootfs mounted for the next session, if
+                        enabled with the warm_rootfs config option
+    :param detach: detach the rootfs lazily instead of waiting for it to be
+                   unmounted. Only for stopping sessions, other callers go on
+                   to change the images or the overlay under it.
+    """
     if not actions.initializer.is_initialized(args):
         raise RuntimeError("Waydroid is not initialized")
 
@@ -232,7 +286,7 @@ def stop(args, quit_session=True):
         if status != "STOPPED":
             helpers.lxc.stop(args)
             while helpers.lxc.status(args) != "STOPPED":
-                pass
+                time.sleep(0.01)
 
         # Networking
         command = [tools.config.tools_src +
@@ -256,7 +310,11 @@ def stop(args, quit_session=True):
                 tools.helpers.run.user(args, command, check=False)
 
         # Umount rootfs
-        helpers.images.umount_rootfs(args)
+        cfg = tools.config.load(args)
+        if keep_rootfs and cfg["waydroid"]["warm_rootfs"] == "True":
+            logging.info("Keeping the rootfs mounted for the next session")
+        else:
+            helpers.images.umount_rootfs(args, detach)
 
         # Backwards compatibility
         with suppress(Exception):
@@ -284,7 +342,7 @@ def freeze(args):
     if status == "RUNNING":
         helpers.lxc.freeze(args)
         while helpers.lxc.status(args) == "RUNNING":
-            pass
+            time.sleep(0.01)
     else:
         logging.error("WayDroid container is {}".format(status))
 
@@ -293,4 +351,4 @@ def unfreeze(args):
     if status == "FROZEN":
         helpers.lxc.unfreeze(args)
         while helpers.lxc.status(args) == "FROZEN":
-            pass
+            time.sleep(0.01)
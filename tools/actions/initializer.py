@@ -94,27 +94,36 @@ def setup_config(args):
         logging.error("ERROR: You must provide 'System OTA' and 'Vendor OTA' URLs.")
         return False
 
-    args.system_ota = args.system_channel + "/" + args.rom_type + \
-        "/waydroid_" + args.arch + "/" + args.system_type + ".json"
-    system_request = helpers.http.retrieve(args.system_ota)
-    if system_request[0] != 200:
+    # A channel can list mirrors after its origin, separated by spaces. All
+    # of them, and all vendor channels the device could have, are probed at
+    # once, the most preferred one that answers is used.
+    system_otas = [channel + "/" + args.rom_type + "/waydroid_" + args.arch +
+                   "/" + args.system_type + ".json"
+                   for channel in args.system_channel.split()]
+    device_codename = helpers.props.host_get(args, "ro.product.device")
+    vendors = list(dict.fromkeys([device_codename, args.vendor_type]))
+    vendor_otas = {vendor: [channel + "/waydroid_" + args.arch + "/" +
+                            vendor.replace(" ", "_") + ".json"
+                            for channel in args.vendor_channel.split()]
+                   for vendor in vendors}
+    vendor_candidates = [(vendor, ota) for vendor in vendors for ota in vendor_otas[vendor]]
+
+    system_probe = helpers.http.Probe(args, system_otas)
+    vendor_probe = helpers.http.Probe(args, [ota for _, ota in vendor_candidates])
+
+    args.system_ota = system_otas[0]
+    system_hit, system_status, _ = system_probe.first()
+    if system_hit is None:
         raise ValueError(
-            "Failed to get system OTA channel: {}, error: {}".format(args.system_ota, system_request[0]))
+            "Failed to get system OTA channel: {}, error: {}".format(args.system_ota, system_status))
 
-    device_codename = helpers.props.host_get(args, "ro.product.device")
-    args.vendor_type = None
-    for vendor in [device_codename, get_vendor_type(args)]:
-        vendor_ota = args.vendor_channel + "/waydroid_" + \
-            args.arch + "/" + vendor.replace(" ", "_") + ".json"
-        vendor_request = helpers.http.retrieve(vendor_ota)
-        if vendor_request[0] == 200:
-            args.vendor_type = vendor
-            args.vendor_ota = vendor_ota
-            break
-
-    if not args.vendor_type:
+    vendor_hit, _, _ = vendor_probe.first()
+    if vendor_hit is None:
         raise ValueError(
-            "Failed to get vendor OTA channel: {}".format(vendor_ota))
+            "Failed to get vendor OTA channel: {}".format(vendor_otas[vendors[-1]][0]))
+    args.vendor_type = vendor_candidates[vendor_hit][0]
+    vendor_otas = vendor_otas[args.vendor_type]
+    args.vendor_ota = vendor_otas[0]
 
     if args.system_ota != cfg["waydroid"].get("system_ota"):
         cfg["waydroid"]["system_datetime"] = tools.config.defaults["system_datetime"]
@@ -124,10 +133,14 @@ def setup_config(args):
     cfg["waydroid"]["vendor_type"] = args.vendor_type
     cfg["waydroid"]["system_ota"] = args.system_ota
     cfg["waydroid"]["vendor_ota"] = args.vendor_ota
+    cfg["waydroid"]["system_ota_mirrors"] = " ".join(system_otas[1:])
+    cfg["waydroid"]["vendor_ota_mirrors"] = " ".join(vendor_otas[1:])
     tools.config.save(args, cfg)
     return True
 
 def init(args):
+    if getattr(args, "progress_fd", None) is not None:
+        helpers.http.progress_to_fd(args.progress_fd)
     if is_initialized(args) and not args.force:
         logging.info("Already initialized")
 
@@ -151,6 +164,8 @@ def init(args):
             except Exception as e:
                 logging.debug(e)
                 tools.actions.container_manager.stop(args, False)
+    # The container service may have kept it mounted for the next session
+    helpers.images.umount_rootfs(args)
     if args.images_path not in tools.config.defaults["preinstalled_images_paths"]:
         helpers.images.get(args)
     else:
@@ -212,6 +227,12 @@ class DbusInitializer(dbus.service.Object):
     def ProgressChanged(self, message):
         pass
 
+    # Phase ("download", "verify", "extract" or "done"), bytes done, bytes
+    # total, current and average rate in bytes/s, seconds left or -1
+    @dbus.service.signal("id.waydro.Initializer", signature='sttddd')
+    def DownloadProgress(self, phase, done, total, rate, average_rate, eta):
+        pass
+
     @dbus.service.signal("id.waydro.Initializer", signature='')
     def Finished(self):
         pass
@@ -255,6 +276,7 @@ def remote_init_proc_entry(args, pipe):
 
     helpers.logging.add_verbose_log_level()
     logging.getLogger().addHandler(out)
+    helpers.http.listeners.append(pipe.send)
 
     try:
         init(args)
@@ -288,7 +310,13 @@ def remote_init_server(_args, dbus_obj, params):
     def monitor_init(p, pipe):
         try:
             while True:
-                dbus_obj.ProgressChanged(pipe.recv())
+                message = pipe.recv()
+                if isinstance(message, dict):
+                    dbus_obj.DownloadProgress(message["phase"], message["done"], message["total"],
+                                              float(message["rate"]), float(message["average_rate"]),
+                                              float(message["eta"]))
+                else:
+                    dbus_obj.ProgressChanged(message)
         except EOFError:
             pass
 
@@ -123,6 +123,6 @@ def stop(args):
 
 def stop_container(quit_session):
     try:
-        tools.helpers.ipc.DBusContainerService().Stop(quit_session)
+        tools.helpers.ipc.DBusContainerService().StopSession(quit_session)
     except dbus.DBusException:
         pass
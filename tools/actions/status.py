@@ -1,8 +1,10 @@
 # Copyright 2021 Erfan Abdi
 # SPDX-License-Identifier: GPL-3.0-or-later
 import tools.config
+import tools.helpers.images
 import tools.helpers.ipc
 import tools.helpers.net
+import tools.helpers.readahead
 import dbus
 
 def print_status(args):
@@ -20,6 +22,13 @@ def print_status(args):
             print("IP address:\t" + (tools.helpers.net.get_device_ip_address() or "UNKNOWN"))
             print("Session user:\t{}({})".format(session["user_name"], session["user_id"]))
             print("Wayland display:\t" + session["wayland_display"])
+            # Without direct I/O loop devices, the page cache holds the
+            # images on top of the file systems mounted from them
+            images_dir = tools.helpers.images.slot_dir(cfg["waydroid"]["images_path"])
+            print("Image page cache:\t{} MB{}".format(
+                round(tools.helpers.readahead.cached(
+                    [images_dir + "/" + name for name in tools.helpers.images.image_names]) / 1000000),
+                " (direct I/O)" if cfg["waydroid"]["loop_direct_io"] == "True" else ""))
         else:
             print_stopped()
     except dbus.DBusException:
@@ -32,7 +32,22 @@ def migration(args):
         logging.debug("Error during migration: %s", e)
 
 def upgrade(args):
+    if getattr(args, "progress_fd", None) is not None:
+        helpers.http.progress_to_fd(args.progress_fd)
     get_config(args)
+    slot = None
+    if args.rollback or not args.offline:
+        if args.images_path in tools.config.defaults["preinstalled_images_paths"]:
+            logging.info("Upgrade refused because Waydroid was configured to load pre-installed image from {}.".format(args.images_path))
+        elif args.rollback:
+            slot = helpers.images.previous_slot(args)
+            if not slot:
+                logging.error("There are no previous images to roll back to")
+                return
+        else:
+            # Android keeps running while the new images are staged
+            with helpers.sched.background(args):
+                slot = helpers.images.get(args, activate=False)
     status = "STOPPED"
     if os.path.exists(tools.config.defaults["lxc"] + "/waydroid"):
         status = helpers.lxc.status(args)
@@ -45,13 +60,12 @@ def upgrade(args):
         except Exception as e:
             logging.debug(e)
             tools.actions.container_manager.stop(args)
+    # The container service may have kept it mounted for the next session
+    helpers.images.umount_rootfs(args)
     migration(args)
     helpers.drivers.loadBinderNodes(args)
-    if not args.offline:
-        if args.images_path not in tools.config.defaults["preinstalled_images_paths"]:
-            helpers.images.get(args)
-        else:
-            logging.info("Upgrade refused because Waydroid was configured to load pre-installed image from {}.".format(args.images_path))
+    if slot:
+        helpers.images.switch_slot(args, slot)
     helpers.drivers.probeAshmemDriver(args)
     helpers.lxc.setup_host_perms(args)
     helpers.lxc.set_lxc_config(args)
@@ -23,7 +23,16 @@ config_keys = ["arch",
                "vendor_datetime",
                "suspend_action",
                "mount_overlays",
-               "auto_adb"]
+               "auto_adb",
+               "prestage_interval",
+               "cache_max_size_mb",
+               "download_rate_limit_mb_per_s",
+               "background_nice",
+               "background_ioprio",
+               "boot_readahead",
+               "loop_direct_io",
+               "erofs_transcode",
+               "warm_rootfs"]
 
 # Config file/commandline default values
 # $WORK gets replaced with the actual value for args.work (which may be
@@ -41,6 +50,15 @@ defaults = {
     "suspend_action": "freeze",
     "mount_overlays": "True",
     "auto_adb": "False",
+    "prestage_interval": "0",
+    "cache_max_size_mb": "0",
+    "download_rate_limit_mb_per_s": "0",
+    "background_nice": "19",
+    "background_ioprio": "idle",
+    "boot_readahead": "True",
+    "loop_direct_io": "False",
+    "erofs_transcode": "False",
+    "warm_rootfs": "False",
     "container_xdg_runtime_dir": "/run/xdg",
     "container_wayland_display": "wayland-0",
 }
@@ -13,3 +13,7 @@ import tools.helpers.gpu
 import tools.helpers.protocol
 import tools.helpers.version
 import tools.helpers.logging
+import tools.helpers.libc
+import tools.helpers.memo
+import tools.helpers.sched
+import tools.helpers.readahead
@@ -26,14 +26,16 @@ def arguments_init(subparser):
     ret.add_argument("-f", "--force", action="store_true",
                      help="re-initialize configs and images")
     ret.add_argument("-c", "--system_channel",
-                     help="custom system channel (options: OTA channel URL; default is Official OTA server)")
+                     help="custom system channel (options: OTA channel URL, optionally followed by mirror URLs separated by spaces; default is Official OTA server)")
     ret.add_argument("-v", "--vendor_channel",
-                     help="custom vendor channel (options: OTA channel URL; default is Official OTA server)")
+                     help="custom vendor channel (options: OTA channel URL, optionally followed by mirror URLs separated by spaces; default is Official OTA server)")
     ret.add_argument("-r", "--rom_type",
                      help="rom type (options: \"lineage\", \"bliss\" or OTA channel URL; default is LineageOS)")
     ret.add_argument("-s", "--system_type",
                      help="system type (options: VANILLA, FOSS or GAPPS; default is VANILLA)")
     ret.add_argument("--client", help="run as user mode, connecting to the remote initializer service", action="store_true")
+    ret.add_argument("--progress-fd", type=int, metavar="FD",
+                     help="write download progress as JSON lines to this file descriptor")
     return ret
 
 def arguments_status(subparser):
@@ -45,6 +47,10 @@ def arguments_upgrade(subparser):
     ret = subparser.add_parser("upgrade", help="upgrade images")
     ret.add_argument("-o", "--offline", action="store_true",
                      help="just for updating configs")
+    ret.add_argument("-r", "--rollback", action="store_true",
+                     help="switch back to the images from before the last upgrade")
+    ret.add_argument("--progress-fd", type=int, metavar="FD",
+                     help="write download progress as JSON lines to this file descriptor")
     return ret
 
 def arguments_log(subparser):
@@ -132,6 +138,15 @@ def arguments_adb(subparser):
     sub.add_parser("disconnect", help="disconnect adb from the Android container")
     return ret
 
+def arguments_cache(subparser):
+    ret = subparser.add_parser("cache", help="manage the download cache")
+    sub = ret.add_subparsers(title="subaction", dest="subaction")
+    sub.add_parser("list", help="list cached downloads")
+    sub.add_parser("prune", help="remove least recently used downloads beyond the configured cache_max_size_mb")
+    sub.add_parser("verify", help="re-check cached downloads and remove corrupt ones")
+    sub.add_parser("clear", help="remove all cached downloads")
+    return ret
+
 def arguments_bugreport(subparser):
     ret = subparser.add_parser("bugreport", help="create a bugreport archive interactively")
     return ret
@@ -172,6 +187,7 @@ def arguments():
     arguments_shell(sub)
     arguments_logcat(sub)
     arguments_adb(sub)
+    arguments_cache(sub)
     arguments_bugreport(sub)
 
     if argcomplete:
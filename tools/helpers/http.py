@@ -1,82 +1,494 @@
 # Copyright 2021 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import fcntl
 import hashlib
+import json
 import logging
 import os
-import shutil
+import re
 import threading
 import urllib.request
+from contextlib import contextmanager, suppress
 
+import tools.config
+import tools.helpers.memo
 import tools.helpers.run
 import time
 
+# Parallel HTTP Range connections used for a single download
+connections = 4
+# Don't split downloads into segments smaller than this
+min_segment_size = 8 * 1024 * 1024
+# Persist the resume state after this many bytes per segment
+state_interval = 16 * 1024 * 1024
+# Read size of the copy loop
+chunk_size = 256 * 1024
+# Attempts per segment before the whole download is given up
+segment_retries = 5
+# Socket timeout, so stalled connections get retried instead of hanging
+timeout = 60
+# Bytes fetched from every mirror to rank them
+probe_size = 256 * 1024
+# Seconds to wait for the answers to concurrent channel probes
+probe_timeout = 15
 
-def download(args, url, prefix, cache=True, loglevel=logging.INFO,
-             allow_404=False):
-    """ Download a file to disk.
 
-        :param url: the http(s) address of to the file to download
-        :param prefix: for the cache, to make it easier to find (cache files
-                       get a hash of the URL after the prefix)
-        :param cache: if True, and url is cached, do not download it again
-        :param loglevel: change to logging.DEBUG to only display the download
-                         message in 'waydroid log', not in stdout. We use
-                         this when downloading many APKINDEX files at once, no
-                         point in showing a dozen messages.
-        :param allow_404: do not raise an exception when the server responds
-                          with a 404 Not Found error. Only display a warning on
-                          stdout (no matter if loglevel is changed).
-        :returns: path to the downloaded file in the cache or None on 404 """
+class _RateLimit:
+    """ Token bucket shared by all download threads, to keep the total
+        download rate below the download_rate_limit_mb_per_s config option. """
 
-    # helper functions for progress
-    def fromBytesToMB(numBytes, decimalPlaces=2):
-        return round(int(numBytes)/1000000, decimalPlaces)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.allowance = 0
+        self.last = time.monotonic()
+
+    def configure(self, args):
+        cfg = tools.config.load(args)
+        rate = int(float(cfg["waydroid"]["download_rate_limit_mb_per_s"]) * 1000 * 1000)
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.allowance = rate
+
+    def consume(self, size):
+        """ Account for size bytes received, and sleep as long as needed to
+            stay within the rate. """
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            # Allow bursts of up to a second worth of data
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+_rate_limit = _RateLimit()
+
+
+def _open(url, start=None, end=None):
+    headers = {}
+    if start is not None:
+        headers["Range"] = "bytes={}-{}".format(start, "" if end is None else end)
+    req = urllib.request.Request(url, headers=headers)
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def _range_total(response):
+    """ Get the full size of the resource from a 206 response to a range
+        request, or None if the server does not support ranges. """
+    if response.status != 206:
+        return None
+    match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    if not match:
+        return None
+    return int(match.group(1))
+
+
+def _load_state(state_path, url, size, validator):
+    """ Load the segment list of an interrupted download, if it still matches
+        the resource on the server. """
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or state.get("size") != size or \
+            state.get("validator") != validator:
+        return None
+    return state
+
+
+def _save_state(state_path, state):
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def _split(size):
+    count = max(1, min(connections, size // min_segment_size))
+    step = size // count
+    segments = []
+    for i in range(count):
+        start = i * step
+        end = size - 1 if i == count - 1 else start + step - 1
+        segments.append([start, end, 0])
+    return segments
+
+
+class _InOrder:
+    """ Pass the content of a file that is written in segments to a sink in
+        file order. Data at the current position is handed over from memory,
+        data that arrived ahead of it is read back from the file once the
+        position has caught up with it. """
+
+    def __init__(self, sink, path, segments):
+        self.sink = sink
+        self.path = path
+        self.segments = segments
+        self.pos = 0
+        self.lock = threading.Lock()
+
+    def feed(self, offset, data):
+        """ Called after data was written to the file at offset. """
+        with self.lock:
+            if offset <= self.pos < offset + len(data):
+                self.sink.update(data[self.pos - offset:])
+                self.pos = offset + len(data)
+            self.catch_up()
+
+    def catch_up(self):
+        moved = True
+        while moved:
+            moved = False
+            for start, _, done in self.segments:
+                if start <= self.pos < start + done:
+                    with open(self.path, "rb") as f:
+                        f.seek(self.pos)
+                        while self.pos < start + done:
+                            data = f.read(min(chunk_size, start + done - self.pos))
+                            self.sink.update(data)
+                            self.pos += len(data)
+                    moved = True
 
-    def getDownloadSpeed(lastSize, currentSize, timeTaken, decimalPlaces=2):
-        # sizes are in MB and timeTaken in seconds
-        speedUnit = "MB/s"
-        sizeDifference = currentSize-lastSize
 
-        if sizeDifference < 1:
-            # sizeDifference is less than 1 MB
-            # convert sizeDifference to kB and speedUnit to kB/s,
-            # for better readability
-            sizeDifference*=1000
-            speedUnit = "kB/s"
+def _download_segments(urls, part_path, state_path, state, counter, ordered=None):
+    """ Fetch all missing bytes of the segments in state with one HTTP Range
+        connection per segment, writing them in place into part_path. When a
+        connection fails, the segment continues from the next of the mirror
+        urls. """
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
 
-        # sizeDifference MB(or kB) was downloaded in timeTaken seconds
-        # so downloadSpeed = sizeDifference/timeTaken MB/s(or kB/s)
-        return (round(sizeDifference/timeTaken, decimalPlaces), speedUnit)
+    def save():
+        with lock:
+            _save_state(state_path, state)
 
-    # Show progress while downloading
-    downloadEnded = False
-    def progress(totalSize, destinationPath):
-        # convert totalSize to MB before hand,
-        # it's value won't change inside while loop and
-        # will be unnecessarily calculated every .01 seconds
-        totalSize = fromBytesToMB(totalSize)
+    def worker(fd, segment):
+        # Failures in a row without progress, and attempts for picking mirrors
+        failures = 0
+        attempts = 0
+        unsaved = 0
+        while segment[0] + segment[2] <= segment[1] and not stop.is_set():
+            url = urls[attempts % len(urls)]
+            done = segment[2]
+            try:
+                with _open(url, segment[0] + segment[2], segment[1]) as response:
+                    if response.status != 206:
+                        raise OSError("Server ignored range request")
+                    while not stop.is_set():
+                        data = response.read(chunk_size)
+                        if not data:
+                            break
+                        _rate_limit.consume(len(data))
+                        offset = segment[0] + segment[2]
+                        os.pwrite(fd, data, offset)
+                        with lock:
+                            segment[2] += len(data)
+                            counter[0] += len(data)
+                        if ordered:
+                            ordered.feed(offset, data)
+                        unsaved += len(data)
+                        if unsaved >= state_interval:
+                            save()
+                            unsaved = 0
+                if segment[0] + segment[2] <= segment[1] and not stop.is_set():
+                    raise OSError("Connection closed early")
+            except Exception as e:
+                if segment[2] > done:
+                    failures = 0
+                failures += 1
+                attempts += 1
+                if failures >= segment_retries + len(urls) - 1:
+                    errors.append(e)
+                    stop.set()
+                    return
+                logging.debug("Retrying segment {}-{} of {}: {}".format(
+                    segment[0], segment[1], url, e))
+                # Fail over to the next mirror right away
+                if attempts % len(urls) == 0:
+                    time.sleep(failures)
 
-        # this value will be used to figure out maximum chars
-        # required to denote downloaded size later on
-        totalSizeStrLen = len(str(totalSize))
+    fd = os.open(part_path, os.O_WRONLY)
+    threads = [threading.Thread(target=worker, args=(fd, segment), daemon=True)
+               for segment in state["segments"]]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so KeyboardInterrupt reaches us
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        os.close(fd)
+        save()
+
+    if errors:
+        raise errors[0]
+
+
+class _Tee:
+    """ Feed the same data to several digests. """
+
+    def __init__(self, *digests):
+        self.digests = [digest for digest in digests if digest is not None]
+
+    def update(self, data):
+        for digest in self.digests:
+            digest.update(data)
+
+
+# Serializes access to the cache index between threads, the file lock only
+# works between processes
+_index_lock = threading.Lock()
+
+
+@contextmanager
+def cache_index(args):
+    """ Load the index of the download cache, and save it again with the
+        changes made in the with block.
+
+        The index maps the names of the files in cache_http to a dict with
+        the "url" they were downloaded from, their "size", the "sha256" of
+        their content and the time they were last "accessed". Entries of
+        files that are gone are dropped. """
+    cache_dir = args.work + "/cache_http"
+    os.makedirs(cache_dir, exist_ok=True)
+    with _index_lock, open(cache_dir + "/index.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(cache_dir + "/index.json") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        for name in list(index):
+            if not os.path.exists(cache_dir + "/" + name):
+                del index[name]
+        yield index
+        with open(cache_dir + "/index.json.tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(cache_dir + "/index.json.tmp", cache_dir + "/index.json")
+
+
+def _cache_add(args, path, url, sha256):
+    """ Record a file in the cache index and mark it as just used. """
+    with cache_index(args) as index:
+        index[os.path.basename(path)] = {"url": url,
+                                         "size": os.path.getsize(path),
+                                         "sha256": sha256,
+                                         "accessed": time.time()}
+
+
+def _read_cached(path, digest, phase):
+    """ Feed a cached file to digest, reporting the progress as phase. """
+    progress = Progress(phase)
+    counter = progress.track()
+    counter[1] = os.path.getsize(path)
+    try:
+        with open(path, "rb") as handle:
+            for data in iter(lambda: handle.read(chunk_size), b""):
+                digest.update(data)
+                counter[0] += len(data)
+    finally:
+        progress.stop()
+
+
+def _cache_hit(args, path, url, digest):
+    """ Check a cached file against the size and hash recorded in the index,
+        and feed it to digest. The hash is checked before anything is fed,
+        so a corrupt file can still be downloaded again. Files that are
+        unchanged since they were verified aren't hashed again, see
+        helpers.memo.get().
+
+        :returns: False when the file has to be downloaded again """
+    with cache_index(args) as index:
+        entry = index.get(os.path.basename(path), {})
+    if entry.get("size", os.path.getsize(path)) != os.path.getsize(path):
+        logging.warning("Cached {} has the wrong size, downloading it again".format(url))
+        return False
+    sha256 = entry.get("sha256")
+    known = tools.helpers.memo.get(args, path) or {}
+    if sha256:
+        if known.get("sha256") != sha256:
+            actual = hashlib.sha256()
+            _read_cached(path, actual, "verify")
+            if actual.hexdigest() != sha256:
+                logging.warning("Cached {} is corrupt, downloading it again".format(url))
+                return False
+            tools.helpers.memo.put(args, path, sha256=sha256)
+        if digest is not None:
+            _read_cached(path, digest, "extract")
+    else:
+        # Files cached before the index recorded hashes
+        actual = hashlib.sha256()
+        _read_cached(path, _Tee(actual, digest), "verify")
+        sha256 = actual.hexdigest()
+    _cache_add(args, path, url, sha256)
+    return True
 
-        # lastSize and lastSizeChangeAt is used to calculate speed
-        lastSize = 0
-        lastSizeChangeAt = time.time()
 
-        downloadSpeed = 0, "MB/s"
+def cache_limit(args):
+    """ :returns: the configured maximum size of the download cache in
+                  bytes, 0 when files are removed once they were used """
+    cfg = tools.config.load(args)
+    return int(float(cfg["waydroid"]["cache_max_size_mb"]) * 1000 * 1000)
 
-        while not downloadEnded:
-            currentSize = fromBytesToMB(os.path.getsize(destinationPath))
 
-            sizeChangeAt = time.time()
-            downloadSpeed = getDownloadSpeed(
-                lastSize, currentSize,
-                timeTaken=sizeChangeAt-lastSizeChangeAt
-            )
+def cache_evict(args, limit, keep=None):
+    """ Remove the least recently used files from the download cache, until
+        the files in its index take up no more than limit bytes.
 
-            lastSize = currentSize
-            lastSizeChangeAt = sizeChangeAt
+        :param keep: path of a file that is not removed
+        :returns: the number of bytes freed """
+    cache_dir = args.work + "/cache_http"
+    freed = 0
+    with cache_index(args) as index:
+        total = sum(entry["size"] for entry in index.values())
+        for name in sorted(index, key=lambda name: index[name]["accessed"]):
+            if total <= limit:
+                break
+            if keep and name == os.path.basename(keep):
+                continue
+            logging.debug("Evicting {} from the cache".format(index[name]["url"]))
+            os.remove(cache_dir + "/" + name)
+            total -= index[name]["size"]
+            freed += index[name]["size"]
+            del index[name]
+    return freed
+
+
+def release(args, path):
+    """ Tell the cache that a downloaded file has been used. It is removed
+        right away, unless the cache is allowed to keep files (the
+        cache_max_size_mb config option), then it stays until it gets evicted. """
+    limit = cache_limit(args)
+    if limit:
+        cache_evict(args, limit)
+        return
+    with cache_index(args) as index:
+        index.pop(os.path.basename(path), None)
+        os.remove(path)
+
+
+# Functions called with a dict for every progress update, see Progress.event()
+listeners = []
+
+
+def progress_to_fd(fd):
+    """ Write progress events as JSON lines to a file descriptor, for
+        tools that drive waydroid. """
+    stream = os.fdopen(fd, "w", buffering=1)
+
+    def write(event):
+        with suppress(OSError):
+            stream.write(json.dumps(event) + "\n")
+    listeners.append(write)
+
+
+class Progress:
+    """ Track the combined progress of one or more concurrent transfers.
+        It is printed on a single status line, and sent to the listeners as
+        events. """
+    # Seconds between updates
+    interval = 1
+    labels = {"download": "Downloading", "verify": "Verifying", "extract": "Extracting"}
+
+    def __init__(self, phase="download"):
+        self.counters = []
+        self.ended = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.phase = phase
+        self.started = None
+        self.base = 0
+
+    def track(self):
+        """ Start tracking a transfer.
+            :returns: [transferred bytes, total bytes] list for the caller to
+                      update """
+        counter = [0, 0]
+        with self.lock:
+            self.counters.append(counter)
+            if self.thread is None:
+                # adding daemon=True will kill this thread if main thread is killed
+                # else progress_bar will continue to show even if user cancels download by ctrl+c
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return counter
+
+    def stop(self):
+        if self.ended.is_set():
+            return
+        self.ended.set()
+        if self.thread is not None:
+            self.thread.join()
+            done, total = self.sizes()
+            self.notify(self.event(done, total, 0, "done"))
+
+    def sizes(self):
+        with self.lock:
+            return (sum(counter[0] for counter in self.counters),
+                    sum(counter[1] for counter in self.counters))
+
+    def event(self, done, total, rate, phase=None):
+        """ :returns: dict with the phase ("download", "verify", "extract",
+                      or "done" at the end), the bytes done and total, the
+                      current and average rate in bytes/s and the estimated
+                      seconds left (-1 if unknown) """
+        elapsed = time.monotonic() - self.started
+        average = (done - self.base) / elapsed if elapsed > 0 else 0
+        eta = (total - done) / average if average > 0 and total >= done else -1
+        return {"phase": phase or self.phase, "done": done, "total": total,
+                "rate": round(rate), "average_rate": round(average), "eta": round(eta, 1)}
+
+    @staticmethod
+    def notify(event):
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logging.debug("Progress listener failed: {}".format(e))
+
+    # helper functions for progress
+    @staticmethod
+    def fromBytesToMB(numBytes, decimalPlaces=2):
+        return round(int(numBytes)/1000000, decimalPlaces)
+
+    @staticmethod
+    def getDownloadSpeed(rate, decimalPlaces=2):
+        # rate is in bytes/s
+        if rate < 1000000:
+            # convert to kB/s for better readability
+            return (round(rate/1000, decimalPlaces), "kB/s")
+        return (round(rate/1000000, decimalPlaces), "MB/s")
+
+    def run(self):
+        self.started = time.monotonic()
+        # Bytes done by an earlier, resumed attempt don't count for the rate
+        self.base = lastDone = self.sizes()[0]
+        lastTime = self.started
+
+        while not self.ended.wait(self.interval):
+            done, total = self.sizes()
+            now = time.monotonic()
+            rate = (done - lastDone) / (now - lastTime)
+            lastDone, lastTime = done, now
+            self.notify(self.event(done, total, rate))
+
+            currentSize = self.fromBytesToMB(done)
+            totalSize = self.fromBytesToMB(total)
+
+            # this value will be used to figure out maximum chars
+            # required to denote downloaded size later on
+            totalSizeStrLen = len(str(totalSize))
 
             # make currentSize and downloadSpeed of a fix max len,
             # to avoid previously printed chars to appear while \
@@ -84,11 +496,75 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
             # currentSize is not going to exceed totalSize
             currentSize = str(currentSize).rjust(totalSizeStrLen)
             # assuming max downloadSpeed to be 9999.99 MB/s
+            downloadSpeed = self.getDownloadSpeed(rate)
             downloadSpeed = f"{str(downloadSpeed[0]).rjust(7)} {downloadSpeed[1]}"
 
             # print progress bar
-            print(f"\r[Downloading] {currentSize} MB/{totalSize} MB    {downloadSpeed}(approx.)", end=" ")
-            time.sleep(2)
+            label = self.labels.get(self.phase, self.phase)
+            print(f"\r[{label}] {currentSize} MB/{totalSize} MB    {downloadSpeed}(approx.)", end=" ")
+
+
+def rank_mirrors(urls):
+    """ Order mirrors of a file by how fast they deliver its first bytes,
+        which covers both latency and throughput. The mirrors are probed
+        concurrently, mirrors that fail are put last.
+
+        :param urls: list of addresses of the same file
+        :returns: the sorted list """
+    elapsed = {}
+
+    def probe(url):
+        start = time.monotonic()
+        try:
+            with _open(url, 0, probe_size - 1) as response:
+                response.read()
+            elapsed[url] = time.monotonic() - start
+        except Exception as e:
+            logging.debug("Mirror {} failed: {}".format(url, e))
+
+    threads = [threading.Thread(target=probe, args=(url,), daemon=True) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout)
+    ranked = sorted(urls, key=lambda url: elapsed.get(url, float("inf")))
+    for url in ranked:
+        logging.debug("Mirror {}: {}".format(url, "{:.2f}s".format(elapsed[url])
+                                              if url in elapsed else "failed"))
+    return ranked
+
+
+def download(args, url, prefix, cache=True, loglevel=logging.INFO,
+             allow_404=False, digest=None, progress=None, mirrors=None):
+    """ Download a file to disk.
+
+        Servers that support HTTP Range requests are downloaded over several
+        connections. Interrupted downloads leave a ".part" file and its
+        segment state in the cache and continue from there on the next call,
+        even with cache=False.
+
+        :param url: the http(s) address of to the file to download
+        :param prefix: for the cache, to make it easier to find (cache files
+                       get a hash of the URL after the prefix)
+        :param cache: if True, and url is cached, do not download it again
+        :param loglevel: change to logging.DEBUG to only display the download
+                         message in 'waydroid log', not in stdout. We use
+                         this when downloading many APKINDEX files at once, no
+                         point in showing a dozen messages.
+        :param allow_404: do not raise an exception when the server responds
+                          with a 404 Not Found error. Only display a warning on
+                          stdout (no matter if loglevel is changed).
+        :param digest: object with an update() method, e.g. hashlib.sha256(),
+                       that gets fed the whole content of the file in order
+                       while it is downloaded, or read from the cache
+        :param progress: Progress instance to report to, so the progress of
+                         concurrent downloads is shown together
+        :param mirrors: list of other addresses of the same file. They are
+                        ranked with rank_mirrors(), and a download fails over
+                        to the next one when a connection breaks. The file is
+                        cached under url, so an interrupted download resumes
+                        from any mirror.
+        :returns: path to the downloaded file in the cache or None on 404 """
 
     # Create cache folder
     if not os.path.exists(args.work + "/cache_http"):
@@ -99,38 +575,177 @@ def download(args, url, prefix, cache=True, loglevel=logging.INFO,
     path = (args.work + "/cache_http/" + prefix + "_" +
             hashlib.sha256(url.encode("utf-8")).hexdigest())
     if os.path.exists(path):
-        if cache:
+        if cache and _cache_hit(args, path, url, digest):
             return path
         tools.helpers.run.user(args, ["rm", path])
+    part_path = path + ".part"
+    state_path = path + ".state"
+    # The hash of the content for the cache index
+    sha256 = hashlib.sha256()
+    digest = _Tee(sha256, digest)
+
+    own_progress = progress is None
+    if own_progress:
+        progress = Progress()
+    # Bytes of the file on disk and its size, shared with the download threads
+    counter = progress.track()
+
+    _rate_limit.configure(args)
+    urls = [url]
+    if mirrors:
+        urls = rank_mirrors([url] + mirrors)
 
     # Download the file
-    logging.log(loglevel, "Downloading " + url)
+    logging.log(loglevel, "Downloading " + urls[0])
     try:
-        with urllib.request.urlopen(url) as response:
-            with open(path, "wb") as handle:
-                # adding daemon=True will kill this thread if main thread is killed
-                # else progress_bar will continue to show even if user cancels download by ctrl+c
-                threading.Thread(target=progress, args=(response.headers.get('content-length'), path), daemon=True).start()
-                shutil.copyfileobj(response, handle)
+        # Probe for range support with the first byte of the file
+        for i, source in enumerate(urls):
+            try:
+                try:
+                    response = _open(source, 0, 0)
+                except urllib.error.HTTPError as e:
+                    # Range not satisfiable, e.g. empty file
+                    if e.code != 416:
+                        raise
+                    response = _open(source)
+                break
+            except (urllib.error.URLError, OSError) as e:
+                if i == len(urls) - 1:
+                    raise
+                logging.warning("{} failed, trying {}: {}".format(source, urls[i + 1], e))
+        size = _range_total(response)
+        if size is None:
+            # No range support, fall back to a single stream
+            counter[1] = int(response.headers.get('content-length') or 0)
+            with response, open(part_path, "wb") as handle:
+                for data in iter(lambda: response.read(chunk_size), b""):
+                    _rate_limit.consume(len(data))
+                    handle.write(data)
+                    counter[0] += len(data)
+                    digest.update(data)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+        else:
+            validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+            if mirrors:
+                # Mirrors have their own ETags, the content is the same
+                validator = None
+            response.close()
+            state = None
+            if os.path.exists(part_path):
+                state = _load_state(state_path, url, size, validator)
+            if state is None:
+                state = {"url": url, "size": size, "validator": validator,
+                         "segments": _split(size)}
+                with open(part_path, "wb") as handle:
+                    handle.truncate(size)
+                _save_state(state_path, state)
+            else:
+                logging.log(loglevel, "Resuming interrupted download")
+            counter[0] = sum(segment[2] for segment in state["segments"])
+            # Hash what a previous attempt has downloaded already
+            ordered = _InOrder(digest, part_path, state["segments"])
+            ordered.catch_up()
+            counter[1] = size
+            _download_segments(urls[i:] + urls[:i], part_path, state_path, state,
+                               counter, ordered)
+            ordered.catch_up()
+            if ordered.pos != size:
+                raise RuntimeError("Incomplete download: " + url)
+            os.remove(state_path)
     # Handle 404
     except urllib.error.HTTPError as e:
         if e.code == 404 and allow_404:
             logging.warning("WARNING: file not found: " + url)
             return None
         raise
-    downloadEnded = True
+    finally:
+        if own_progress:
+            progress.stop()
+    os.replace(part_path, path)
+    _cache_add(args, path, url, sha256.hexdigest())
+    tools.helpers.memo.put(args, path, sha256=sha256.hexdigest())
+    limit = cache_limit(args)
+    if limit:
+        cache_evict(args, limit, keep=path)
 
     # Return path in cache
     return path
 
 
-def retrieve(url, headers=None):
-    """ Fetch the content of a URL and returns it as string.
+def download_ranges(args, url, ranges, write, progress=None):
+    """ Fetch byte ranges of a file over parallel HTTP Range connections.
 
-        :param url: the http(s) address of to the resource to fetch
-        :param headers: dict of HTTP headers to use
-        :returns: status and str with the content of the response
-    """
+        :param url: the http(s) address of the file
+        :param ranges: list of (start, end) tuples, end is inclusive
+        :param write: function(offset, data), called from the download
+                      threads with every chunk that arrives
+        :param progress: Progress instance to report to """
+    _rate_limit.configure(args)
+    own_progress = progress is None
+    if own_progress:
+        progress = Progress()
+    counter = progress.track()
+    counter[1] = sum(end - start + 1 for start, end in ranges)
+
+    pending = list(reversed(ranges))
+    lock = threading.Lock()
+    stop = threading.Event()
+    errors = []
+
+    def worker():
+        while not stop.is_set():
+            with lock:
+                if not pending:
+                    return
+                start, end = pending.pop()
+            failures = 0
+            while start <= end and not stop.is_set():
+                done = start
+                try:
+                    with _open(url, start, end) as response:
+                        if response.status != 206:
+                            raise OSError("Server ignored range request")
+                        while start <= end and not stop.is_set():
+                            data = response.read(min(chunk_size, end - start + 1))
+                            if not data:
+                                raise OSError("Connection closed early")
+                            _rate_limit.consume(len(data))
+                            write(start, data)
+                            start += len(data)
+                            with lock:
+                                counter[0] += len(data)
+                except Exception as e:
+                    if start > done:
+                        failures = 0
+                    failures += 1
+                    if failures >= segment_retries:
+                        errors.append(e)
+                        stop.set()
+                        return
+                    logging.debug("Retrying range {}-{} of {}: {}".format(start, end, url, e))
+                    time.sleep(failures)
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(min(connections, len(ranges)))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so KeyboardInterrupt reaches us
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        stop.set()
+        if own_progress:
+            progress.stop()
+
+    if errors:
+        raise errors[0]
+
+
+def _retrieve(url, headers=None, timeout=None):
+    """ Like retrieve(), but also return the headers of the response. """
     # Download the file
     logging.verbose("Retrieving " + url)
 
@@ -139,13 +754,151 @@ def retrieve(url, headers=None):
 
     try:
         req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req) as response:
-            return 200, response.read()
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return 200, response.read(), response.headers
     # Handle malformed URL
     except ValueError:
-        return -1, ""
+        return -1, "", {}
     # Handle 404
     except urllib.error.HTTPError as e:
-        return e.code, ""
-    except urllib.error.URLError:
-        return -2, ""
+        return e.code, "", e.headers
+    except (urllib.error.URLError, OSError):
+        return -2, "", {}
+
+
+def retrieve(url, headers=None, timeout=None):
+    """ Fetch the content of a URL and returns it as string.
+
+        :param url: the http(s) address of to the resource to fetch
+        :param headers: dict of HTTP headers to use
+        :param timeout: socket timeout in seconds
+        :returns: status and str with the content of the response
+    """
+    return _retrieve(url, headers, timeout)[:2]
+
+
+def retrieve_cached(args, url, offline=False, max_stale=7*24*3600, timeout=None):
+    """ Fetch the content of a URL like retrieve(), but keep a copy of it in
+        the cache together with its ETag and Last-Modified headers. Later
+        calls send a conditional request and get the content from the cache
+        when the server answers 304 Not Modified. Used for the OTA channel
+        JSON files, which are fetched repeatedly.
+
+        :param offline: return the cached copy, however old, without
+                        asking the server. Without a cached copy the status
+                        is -2, like for a server that can't be reached.
+        :param max_stale: age in seconds up to which a cached copy is used
+                          when the server can't be reached
+        :param timeout: socket timeout in seconds
+        :returns: status and str with the content of the response
+    """
+    cache_dir = args.work + "/cache_http/channels"
+    path = cache_dir + "/" + hashlib.sha256(url.encode("utf-8")).hexdigest()
+    meta = None
+    try:
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        with open(path, "rb") as f:
+            content = f.read()
+    except (OSError, ValueError):
+        meta = None
+    fresh = meta is not None and time.time() - meta["fetched"] <= max_stale
+
+    if offline:
+        if meta is None:
+            logging.verbose("Not cached: " + url)
+            return -2, ""
+        logging.verbose("Using cached " + url + ("" if fresh else ", which is stale"))
+        return 200, content
+
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    code, body, response_headers = _retrieve(url, headers, timeout)
+
+    if code == 304 and meta is not None:
+        logging.verbose("Not modified: " + url)
+        body = content
+    elif code == 200:
+        meta = {"url": url,
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified")}
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, threading.get_native_id())
+        with open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
+    elif code == -2 and fresh:
+        logging.warning("Could not reach {}, using the cached copy".format(url))
+        return 200, content
+    else:
+        return code, body
+
+    meta["fetched"] = time.time()
+    tmp = "{}.{}.json.tmp".format(path, threading.get_native_id())
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path + ".json")
+    return 200, body
+
+
+class Probe:
+    """ Fetch alternative URLs concurrently with retrieve_cached(), like the
+        mirrors of a channel or the channels a device could have. Repeated
+        probes are conditional requests, which the server answers without
+        a body if nothing changed. """
+
+    def __init__(self, args, urls, timeout=probe_timeout):
+        """ :param urls: list of URLs, the preferred ones first
+            :param timeout: seconds after which unanswered URLs count as
+                            failed """
+        self.urls = urls
+        self.results = [None] * len(urls)
+        self.deadline = time.monotonic() + timeout
+        self.done = threading.Condition()
+        for i in range(len(urls)):
+            threading.Thread(target=self.fetch, args=(args, i, timeout), daemon=True).start()
+
+    def fetch(self, args, i, timeout):
+        try:
+            result = retrieve_cached(args, self.urls[i], timeout=timeout)
+        except Exception as e:
+            logging.debug("Probing {} failed: {}".format(self.urls[i], e))
+            result = (-2, "")
+        with self.done:
+            self.results[i] = result
+            self.done.notify_all()
+
+    def first(self):
+        """ Wait until the most preferred URL that could be fetched is known.
+            Less preferred URLs that didn't answer yet are not waited for.
+
+            :returns: index of that URL, status and content; or None and
+                      the status and content of the first URL """
+        with self.done:
+            for i in range(len(self.urls)):
+                while self.results[i] is None:
+                    left = self.deadline - time.monotonic()
+                    if left <= 0:
+                        logging.debug("No answer from {} in time".format(self.urls[i]))
+                        break
+                    self.done.wait(left)
+                if self.results[i] is not None and self.results[i][0] == 200:
+                    return (i, *self.results[i])
+            return (None, *(self.results[0] or (-2, "")))
+
+    def all(self):
+        """ Wait until all URLs answered, or the timeout passed.
+
+            :returns: list of status and content of every URL, None for the
+                      ones that didn't answer in time """
+        with self.done:
+            while None in self.results:
+                left = self.deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.done.wait(left)
+            return list(self.results)
@@ -1,16 +1,29 @@
 # Copyright 2021 Erfan Abdi
 # SPDX-License-Identifier: GPL-3.0-or-later
 import logging
+import lzma
+import subprocess
+import tarfile
 import zipfile
 import json
+import fcntl
 import hashlib
 import shutil
+import stat
+import struct
+import threading
+import zlib
 import os
+import urllib.parse
 import tools.config
-from contextlib import suppress
+from contextlib import contextmanager, nullcontext, suppress
 from tools import helpers
 from shutil import which
 
+channels = ["system", "vendor"]
+image_names = [channel + ".img" for channel in channels]
+slots = ["slot_a", "slot_b"]
+
 # takes an open file object
 def sha256sum(f):
     h = hashlib.sha256()
@@ -22,103 +35,1182 @@ def sha256sum(f):
     return h.hexdigest()
 
 
-def get(args):
+erofs_magic = struct.pack("<I", 0xE0F5E1E2)
+erofs_magic_offset = 1024
+# Fast to decompress, and still about half the size of ext4
+erofs_compression = "lz4hc"
+
+
+class SparseFile:
+    """
+    Write-only file object for images, that seeks over blocks of zeros
+    instead of writing them, so they become holes. The runs of data in
+    between are preallocated as a whole before they are written, which
+    keeps their extents contiguous.
+    """
+    block_size = 4096
+    # Largest run of data that is buffered before it is written
+    run_size = 8 * 1024 * 1024
+    zero_block = bytes(block_size)
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.pending = bytearray()
+        self.run = bytearray()
+        self.run_start = 0
+        self.offset = 0
+        self.fallocate = hasattr(os, "posix_fallocate")
+
+    def write(self, data):
+        self.pending += data
+        blocks = len(self.pending) - len(self.pending) % self.block_size
+        for i in range(0, blocks, self.block_size):
+            block = self.pending[i:i + self.block_size]
+            if block == self.zero_block:
+                self.flush_run()
+                self.offset += self.block_size
+                self.run_start = self.offset
+            else:
+                self.run += block
+                self.offset += self.block_size
+                if len(self.run) >= self.run_size:
+                    self.flush_run()
+                    self.run_start = self.offset
+        del self.pending[:blocks]
+        return len(data)
+
+    def flush_run(self):
+        if not self.run:
+            return
+        fd = self.f.fileno()
+        if self.fallocate:
+            try:
+                os.posix_fallocate(fd, self.run_start, len(self.run))
+            except OSError:
+                # Not supported by the filesystem
+                self.fallocate = False
+        os.pwrite(fd, self.run, self.run_start)
+        self.run = bytearray()
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            if self.pending.count(0) != len(self.pending):
+                self.run += self.pending
+            self.flush_run()
+            self.f.truncate(self.offset + len(self.pending))
+            st = os.fstat(self.f.fileno())
+        finally:
+            self.f.close()
+        if st.st_size >= 1024 * 1024:
+            logging.info("{}: {} MB on disk, {} MB saved by holes".format(
+                os.path.basename(self.path), round(st.st_blocks * 512 / 1000000),
+                round(max(st.st_size - st.st_blocks * 512, 0) / 1000000)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Staging:
+    """
+    Files written to a staging name next to their destination in dest, that
+    are only moved into place by commit(), after the caller verified them.
+    """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.staged = []
+
+    def staging_path(self, name):
+        return os.path.join(self.dest, name + ".new")
+
+    def commit(self):
+        """ Atomically move all staged files into place. """
+        for name in self.staged:
+            os.replace(self.staging_path(name), os.path.join(self.dest, name))
+        self.staged = []
+
+    def abort(self):
+        """ Remove all staged files. """
+        for name in self.staged:
+            with suppress(OSError):
+                os.remove(self.staging_path(name))
+        self.staged = []
+
+
+class ZipStream(Staging):
+    """
+    Extract a zip file while it is being downloaded or read, and hash the
+    compressed stream at the same time. It is fed through update() like a
+    hashlib object, so it can be passed as digest to helpers.http.download().
+
+    The extracted files are staged. If the zip uses features the streaming
+    parser doesn't handle, failed is set and the caller extracts the
+    finished file with extract() instead.
+    """
+    # Upper bound for the memory a single inflate call may produce
+    max_inflate = 16 * 1024 * 1024
+
+    def __init__(self, dest):
+        super().__init__(dest)
+        self.sha256 = hashlib.sha256()
+        self.buf = bytearray()
+        self.state = "header"
+        self.out = None
+        self.failed = None
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def update(self, data):
+        self.sha256.update(data)
+        if self.failed or self.state == "done":
+            return
+        self.buf += data
+        try:
+            while self.step():
+                pass
+        except (ValueError, OSError, zlib.error, struct.error) as e:
+            self.failed = str(e)
+            logging.debug("Streaming extraction failed: " + self.failed)
+            self.buf = bytearray()
+
+    def step(self):
+        """ Parse as much of the buffer as possible in the current state.
+            :returns: True when the state changed and parsing can go on """
+        if self.state == "header":
+            if len(self.buf) < 4:
+                return False
+            signature = struct.unpack_from("<I", self.buf)[0]
+            if signature != 0x04034b50:
+                # Central directory, nothing left to extract
+                if signature in [0x02014b50, 0x06054b50, 0x06064b50]:
+                    self.state = "done"
+                    self.buf = bytearray()
+                    return False
+                raise ValueError("Bad zip header signature")
+            if len(self.buf) < 30:
+                return False
+            (flags, method, crc, csize, usize,
+             name_len, extra_len) = struct.unpack_from("<2xHH4xIIIHH", self.buf, 4)
+            if len(self.buf) < 30 + name_len + extra_len:
+                return False
+            name = self.buf[30:30 + name_len].decode("utf-8", "replace")
+            extra = bytes(self.buf[30 + name_len:30 + name_len + extra_len])
+            del self.buf[:30 + name_len + extra_len]
+            if flags & 0x1:
+                raise ValueError("Encrypted zip members are not supported")
+            if method not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+                raise ValueError("Unsupported compression method {}".format(method))
+            self.zip64 = False
+            if csize == 0xffffffff or usize == 0xffffffff:
+                usize, csize = self.zip64_sizes(extra, usize, csize)
+            self.descriptor = bool(flags & 0x8)
+            if self.descriptor and method == zipfile.ZIP_STORED:
+                raise ValueError("Stored zip members with data descriptor are not supported")
+            self.method = method
+            self.remaining = csize
+            self.expected = (crc, usize)
+            self.crc = 0
+            self.size = 0
+            self.inflater = zlib.decompressobj(-15)
+            self.open_member(name)
+            self.state = "data"
+            return True
+
+        if self.state == "data":
+            if not self.buf:
+                return False
+            if self.descriptor:
+                chunk = bytes(self.buf)
+            else:
+                chunk = bytes(self.buf[:self.remaining])
+            del self.buf[:len(chunk)]
+            self.remaining -= len(chunk)
+            if self.method == zipfile.ZIP_STORED:
+                self.write(chunk)
+            else:
+                self.write(self.inflater.decompress(chunk, self.max_inflate))
+                while self.inflater.unconsumed_tail and not self.inflater.eof:
+                    self.write(self.inflater.decompress(
+                        self.inflater.unconsumed_tail, self.max_inflate))
+                if self.inflater.eof and self.inflater.unused_data:
+                    self.buf[:0] = self.inflater.unused_data
+            if self.descriptor:
+                if not self.inflater.eof:
+                    return False
+                self.state = "descriptor"
+                return True
+            if self.remaining > 0:
+                return False
+            self.close_member()
+            self.state = "header"
+            return True
+
+        if self.state == "descriptor":
+            size = 20 if self.zip64 else 12
+            if len(self.buf) < 4:
+                return False
+            if struct.unpack_from("<I", self.buf)[0] == 0x08074b50:
+                size += 4
+            if len(self.buf) < size:
+                return False
+            offset = size - (20 if self.zip64 else 12)
+            crc = struct.unpack_from("<I", self.buf, offset)[0]
+            usize = struct.unpack_from("<Q" if self.zip64 else "<I", self.buf,
+                                       size - (8 if self.zip64 else 4))[0]
+            self.expected = (crc, usize)
+            del self.buf[:size]
+            self.close_member()
+            self.state = "header"
+            return True
+
+        return False
+
+    def zip64_sizes(self, extra, usize, csize):
+        while len(extra) >= 4:
+            tag, length = struct.unpack_from("<HH", extra)
+            if tag == 0x0001:
+                self.zip64 = True
+                values = extra[4:4 + length]
+                if usize == 0xffffffff:
+                    usize = struct.unpack_from("<Q", values)[0]
+                    values = values[8:]
+                if csize == 0xffffffff:
+                    csize = struct.unpack_from("<Q", values)[0]
+                return usize, csize
+            extra = extra[4 + length:]
+        raise ValueError("Missing zip64 extra field")
+
+    def open_member(self, name):
+        self.name = os.path.basename(name)
+        if name.endswith("/") or not self.name:
+            self.out = None
+            return
+        self.out = SparseFile(self.staging_path(self.name))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.out:
+            self.out.write(data)
+
+    def close_member(self):
+        if (self.crc, self.size) != self.expected:
+            raise ValueError("CRC check failed for " + self.name)
+        if self.out:
+            self.out.close()
+            self.out = None
+            self.staged.append(self.name)
+
+    def finish(self):
+        """ Nothing is buffered, every update() extracts what it can. """
+
+    def extract(self, path):
+        """ Extract a complete zip file to the staging names, for when
+            streaming extraction failed. """
+        self.abort()
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name:
+                    continue
+                with zip_ref.open(info) as src, SparseFile(self.staging_path(name)) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                self.staged.append(name)
+
+    def abort(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+            self.staged.append(self.name)
+        super().abort()
+
+
+class DecompressStream(Staging):
+    """
+    Extract a zstd or xz compressed image payload while it is being
+    downloaded or read, and hash the compressed stream at the same time,
+    like ZipStream. The payload is a single image, or a tar archive of
+    images.
+
+    The system zstd or xz decompress it when they are installed, on all CPU
+    cores where they can, in a pipeline that runs next to the download.
+    Otherwise it is decompressed in-process. The extraction runs in a
+    thread, finish() waits for it and sets failed if it didn't succeed.
+    """
+    commands = {"zst": ["zstd", "-d", "-T0", "-q", "-c"],
+                "xz": ["xz", "-d", "-T0", "-q", "-c"]}
+    # Upper bound for the memory a single in-process decompress call may produce
+    max_output = 16 * 1024 * 1024
+
+    def __init__(self, dest, compression, name=None):
+        """
+        :param compression: "zst", "xz" or None for a plain tar archive
+        :param name: name of the image in a single image payload, None for
+                     a tar archive
+        """
+        super().__init__(dest)
+        self.sha256 = hashlib.sha256()
+        self.compression = compression
+        self.name = name
+        self.failed = None
+        self.start()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def start(self):
+        self.process = None
+        self.decompressor = None
+        self.error = None
+        command = self.commands.get(self.compression)
+        if command and which(command[0]):
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+            self.input = self.process.stdin
+            output = self.process.stdout
+        else:
+            if self.compression:
+                self.decompressor = self.new_decompressor()
+            read_fd, write_fd = os.pipe()
+            self.input = os.fdopen(write_fd, "wb")
+            output = os.fdopen(read_fd, "rb")
+        self.thread = threading.Thread(target=self.extract_from, args=(output,), daemon=True)
+        self.thread.start()
+
+    def new_decompressor(self):
+        if self.compression == "xz":
+            return lzma.LZMADecompressor()
+        try:
+            # New in Python 3.14
+            from compression import zstd
+        except ImportError:
+            raise RuntimeError("zstd is needed to extract zstd compressed images")
+        return zstd.ZstdDecompressor()
+
+    def update(self, data):
+        self.sha256.update(data)
+        if self.failed:
+            return
+        try:
+            self.feed(data)
+        except Exception as e:
+            self.failed = str(e)
+            logging.debug("Streaming extraction failed: " + self.failed)
+
+    def feed(self, data):
+        if self.decompressor is None:
+            self.input.write(data)
+            return
+        while True:
+            self.input.write(self.decompressor.decompress(data, self.max_output))
+            data = b""
+            if self.decompressor.eof:
+                # Concatenated streams
+                data = self.decompressor.unused_data
+                if not data:
+                    return
+                self.decompressor = self.new_decompressor()
+            elif self.decompressor.needs_input:
+                return
+
+    def extract_from(self, output):
+        try:
+            with output:
+                if self.name:
+                    self.copy(output, self.name)
+                else:
+                    with tarfile.open(fileobj=output, mode="r|") as tar:
+                        for member in tar:
+                            name = os.path.basename(member.name)
+                            if member.isfile() and name:
+                                self.copy(tar.extractfile(member), name)
+                    # Padding after the end of the archive
+                    for _ in iter(lambda: output.read(helpers.http.chunk_size), b""):
+                        pass
+        except (OSError, tarfile.TarError) as e:
+            self.error = str(e)
+
+    def copy(self, src, name):
+        try:
+            with SparseFile(self.staging_path(name)) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(self.staging_path(name))
+            raise
+        self.staged.append(name)
+
+    def finish(self):
+        """ Wait until everything passed to update() is extracted. """
+        if self.thread is None:
+            return
+        if self.decompressor is not None and not self.decompressor.eof and not self.failed:
+            self.failed = "Compressed stream is truncated"
+        with suppress(OSError):
+            self.input.close()
+        self.thread.join()
+        self.thread = None
+        if self.process and self.process.wait() != 0 and not self.failed:
+            self.failed = "{} failed with exit code {}".format(
+                self.process.args[0], self.process.returncode)
+        if self.error and not self.failed:
+            self.failed = self.error
+        if self.failed:
+            logging.debug("Streaming extraction failed: " + self.failed)
+
+    def extract(self, path):
+        """ Extract a complete payload file to the staging names again, for
+            when streaming extraction failed. """
+        self.abort()
+        self.failed = None
+        self.start()
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(helpers.http.chunk_size), b""):
+                if self.failed:
+                    break
+                try:
+                    self.feed(data)
+                except Exception as e:
+                    self.failed = str(e)
+        self.finish()
+        if self.failed:
+            raise ValueError("Failed to extract {}: {}".format(path, self.failed))
+
+    def abort(self):
+        if self.thread is not None:
+            if self.process:
+                self.process.kill()
+            # Ends the extraction thread, with an error for the partial file
+            with suppress(OSError):
+                self.input.close()
+            self.thread.join()
+            self.thread = None
+            if self.process:
+                self.process.wait()
+        super().abort()
+
+
+def payload_stream(dest, filename, channel):
+    """
+    :param filename: name of the image payload of a channel, a zip file,
+                     a single image compressed with zstd or xz, or a tar
+                     archive of images that may be compressed with them
+    :returns: ZipStream or DecompressStream to extract the payload to dest
+    """
+    filename = filename.lower()
+    for suffix, compression in [(".zst", "zst"), (".zstd", "zst"), (".xz", "xz")]:
+        if filename.endswith(suffix):
+            base = filename[:-len(suffix)]
+            return DecompressStream(dest, compression,
+                                    None if base.endswith(".tar") else channel + ".img")
+    if filename.endswith(".tar"):
+        return DecompressStream(dest, None)
+    return ZipStream(dest)
+
+
+def is_erofs(path):
+    with open(path, "rb") as f:
+        f.seek(erofs_magic_offset)
+        return f.read(4) == erofs_magic
+
+def same_tree(a, b):
+    """
+    Compare two directory trees: names, types, modes, owners, extended
+    attributes, symlink targets, device numbers and file contents.
+
+    :returns: relative path of the first difference, or None if there is none
+    """
+    for root, dirs, files in os.walk(a):
+        rel = os.path.relpath(root, a)
+        other = os.path.join(b, rel)
+        names = sorted(dirs + files)
+        if sorted(os.listdir(other)) != names:
+            return rel
+        for name in names:
+            path_a = os.path.join(root, name)
+            path_b = os.path.join(other, name)
+            st_a = os.lstat(path_a)
+            st_b = os.lstat(path_b)
+            if (st_a.st_mode, st_a.st_uid, st_a.st_gid) != (st_b.st_mode, st_b.st_uid, st_b.st_gid):
+                return os.path.join(rel, name)
+            xattrs_a = sorted(os.listxattr(path_a, follow_symlinks=False))
+            if xattrs_a != sorted(os.listxattr(path_b, follow_symlinks=False)) or \
+               any(os.getxattr(path_a, x, follow_symlinks=False) != os.getxattr(path_b, x, follow_symlinks=False)
+                   for x in xattrs_a):
+                return os.path.join(rel, name)
+            if stat.S_ISLNK(st_a.st_mode):
+                same = os.readlink(path_a) == os.readlink(path_b)
+            elif stat.S_ISCHR(st_a.st_mode) or stat.S_ISBLK(st_a.st_mode):
+                same = st_a.st_rdev == st_b.st_rdev
+            elif stat.S_ISREG(st_a.st_mode):
+                same = st_a.st_size == st_b.st_size
+                if same:
+                    with open(path_a, "rb") as f_a, open(path_b, "rb") as f_b:
+                        for data in iter(lambda: f_a.read(helpers.http.chunk_size), b""):
+                            if data != f_b.read(len(data)):
+                                same = False
+                                break
+            else:
+                same = True
+            if not same:
+                return os.path.join(rel, name)
+    return None
+
+def transcode(args, path):
+    """
+    Re-pack an ext4 image as a compressed EROFS image with mkfs.erofs, if
+    enabled with the erofs_transcode config option. The new image is mounted
+    and compared with the original before it replaces it, under the same
+    name, so mount_rootfs doesn't need to know. Failures leave the original
+    in place.
+
+    :returns: True if the image was transcoded
+    """
     cfg = tools.config.load(args)
-    system_ota = cfg["waydroid"]["system_ota"]
-    system_request = helpers.http.retrieve(system_ota)
-    if system_request[0] != 200:
-        raise ValueError(
-            "Failed to get system OTA channel: {}, error: {}".format(args.system_ota, system_request[0]))
-    system_responses = json.loads(system_request[1].decode('utf8'))["response"]
-    if len(system_responses) < 1:
-        raise ValueError("No images found on system channel")
-
-    for system_response in system_responses:
-        if system_response['datetime'] > int(cfg["waydroid"]["system_datetime"]):
-            images_zip = helpers.http.download(
-                args, system_response['url'], system_response['filename'], cache=False)
-            logging.info("Validating system image")
-            with open(images_zip, 'rb') as f:
-                if sha256sum(f) != system_response['id']:
-                    with suppress(OSError):
-                        os.remove(images_zip)
-                    raise ValueError("Downloaded system image hash doesn't match, expected: {}".format(
-                        system_response['id']))
-                logging.info("Extracting to " + args.images_path)
-                with zipfile.ZipFile(f, 'r') as zip_ref:
-                    zip_ref.extractall(args.images_path)
-            cfg["waydroid"]["system_datetime"] = str(system_response['datetime'])
-            tools.config.save(args, cfg)
-            os.remove(images_zip)
+    if cfg["waydroid"]["erofs_transcode"] != "True" or is_erofs(path):
+        return False
+    if not which("mkfs.erofs"):
+        logging.warning("mkfs.erofs was not found, keeping {} as it is".format(path))
+        return False
+    work = args.work + "/transcode"
+    source = work + "/source"
+    target = work + "/target"
+    new = path + ".erofs"
+    logging.info("Transcoding {} to EROFS".format(path))
+    try:
+        helpers.mount.mount(args, path, source, umount=True)
+        helpers.run.user(args, ["mkfs.erofs", "-z" + erofs_compression, new, source])
+        helpers.mount.mount(args, new, target, umount=True, mount_type="erofs")
+        difference = same_tree(source, target)
+        if difference is not None:
+            raise RuntimeError("Transcoded image differs at " + difference)
+    except (RuntimeError, OSError) as e:
+        logging.warning("Failed to transcode {}, keeping it as it is: {}".format(path, e))
+        with suppress(FileNotFoundError):
+            os.remove(new)
+        return False
+    finally:
+        for mountpoint in [source, target]:
+            if os.path.isdir(mountpoint):
+                helpers.mount.umount_all(args, mountpoint)
+        shutil.rmtree(work, ignore_errors=True)
+    old_size = os.path.getsize(path)
+    os.replace(new, path)
+    logging.info("Transcoded {} from {} MB to {} MB".format(
+        path, round(old_size / 1000000), round(os.path.getsize(path) / 1000000)))
+    return True
+
+def download_image(args, response, channel, dest, progress=None):
+    """
+    Download, verify and extract the image payload of a channel response,
+    see payload_stream(). It is hashed and extracted while it is downloaded.
+
+    :param dest: directory to extract to
+    :returns: (stream, images_zip), the stream holding the verified, staged
+              images and the path of the payload in the cache. Call
+              stream.commit() to move the images into dest.
+    """
+    stream = payload_stream(dest, response['filename'], channel)
+    logging.info("Extracting to " + dest)
+    try:
+        # The hash is always checked, so a zip left in the cache by an
+        # earlier attempt can be reused
+        mirrors = image_mirrors(args, tools.config.load(args), channel, response)
+        images_zip = helpers.http.download(
+            args, response['url'], response['filename'], digest=stream,
+            progress=progress, mirrors=mirrors)
+        stream.finish()
+        logging.info("Validating {} image".format(channel))
+        if stream.hexdigest() != response['id']:
+            with suppress(OSError):
+                os.remove(images_zip)
+            raise ValueError("Downloaded {} image hash doesn't match, expected: {}".format(
+                channel, response['id']))
+        if stream.failed:
+            stream.extract(images_zip)
+    except BaseException:
+        stream.abort()
+        raise
+    return stream, images_zip
+
+
+def delta_image(args, response, channel, ota, dest, progress=None):
+    """
+    Rebuild the image of a build from the installed image and the blocks
+    that changed, instead of downloading the whole zip.
+
+    This needs a chunk manifest next to the channel JSON (or at the URL in
+    the "chunks" key of the build), with the sha256 of every block of the
+    new image and the URL of the uncompressed image to fetch missing blocks
+    from with HTTP Range requests:
+    {"id": <build id>, "image": "system.img", "size": <bytes>,
+     "sha256": <image hash>, "block_size": <bytes>, "url": <image url>,
+     "blocks": [<block hash>, ...]}
+
+    :param channel: "system" or "vendor", the manifest has to be for its
+                    image
+    :param dest: directory to stage the rebuilt image in
+    :returns: Staging with the verified image, or None when there is no
+              manifest or no installed image to start from
+    """
+    url = urllib.parse.urljoin(ota, response.get('chunks', response['filename'] + ".chunks.json"))
+    code, content = helpers.http.retrieve(url, timeout=helpers.http.timeout)
+    if code != 200:
+        return None
+    manifest = json.loads(content.decode('utf8'))
+    if manifest['id'] != response['id']:
+        raise ValueError("Chunk manifest doesn't belong to build " + response['id'])
+    name = channel + ".img"
+    if manifest['image'] != name:
+        raise ValueError("Chunk manifest is for {}, not {}".format(manifest['image'], name))
+    base = os.path.join(slot_dir(args.images_path), name)
+    if not os.path.isfile(base):
+        return None
+    if is_erofs(base):
+        logging.info("The installed {} was transcoded, no blocks can be reused".format(name))
+        return None
+    size = manifest['size']
+    block_size = manifest['block_size']
+    blocks = manifest['blocks']
+    if len(blocks) != (size + block_size - 1) // block_size:
+        raise ValueError("Chunk manifest has the wrong number of blocks")
+
+    def block_len(i):
+        return min(block_size, size - i * block_size)
+
+    # Filesystem images are block aligned, and unchanged blocks mostly stay
+    # where they were, so the installed image is compared to the manifest
+    # block by block, in a single pass and without an index of its blocks
+    logging.info("Looking for unchanged blocks in " + base)
+    reuse = bytearray(len(blocks))
+    with open(base, "rb") as f:
+        for i, block in enumerate(blocks):
+            data = f.read(block_size)
+            if not data:
+                break
+            if hashlib.sha256(data[:block_len(i)]).hexdigest() == block:
+                reuse[i] = 1
+    zero = {length: hashlib.sha256(bytes(length)).hexdigest()
+            for length in {block_len(0), block_len(len(blocks) - 1)}}
+
+    # Coalesce missing blocks to ranges
+    ranges = []
+    for i, block in enumerate(blocks):
+        if reuse[i] or block == zero[block_len(i)]:
+            continue
+        start = i * block_size
+        if ranges and ranges[-1][1] == start - 1:
+            ranges[-1][1] = start + block_len(i) - 1
+        else:
+            ranges.append([start, start + block_len(i) - 1])
+    missing = sum(end - start + 1 for start, end in ranges)
+    logging.info("Downloading {} MB of changed blocks of {}, {} MB in total".format(
+        round(missing / 1000000), name, round(size / 1000000)))
+
+    staging = Staging(dest)
+    path = staging.staging_path(name)
+    try:
+        with open(path, "wb") as f:
+            f.truncate(size)
+        staging.staged.append(name)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            helpers.http.download_ranges(args, urllib.parse.urljoin(url, manifest['url']),
+                                         ranges, lambda offset, data: os.pwrite(fd, data, offset),
+                                         progress)
+            logging.info("Rebuilding " + name)
+            digest = hashlib.sha256()
+            with open(base, "rb") as src:
+                for i, block in enumerate(blocks):
+                    offset = i * block_size
+                    length = block_len(i)
+                    if block == zero[length]:
+                        # Leave a hole
+                        data = bytes(length)
+                    elif reuse[i]:
+                        data = os.pread(src.fileno(), length, offset)
+                        os.pwrite(fd, data, offset)
+                    else:
+                        data = os.pread(fd, length, offset)
+                        if hashlib.sha256(data).hexdigest() != block:
+                            raise ValueError("Downloaded block {} of {} doesn't match".format(i, name))
+                    digest.update(data)
+        finally:
+            os.close(fd)
+        if digest.hexdigest() != manifest['sha256']:
+            raise ValueError("Rebuilt {} hash doesn't match, expected: {}".format(
+                name, manifest['sha256']))
+    except BaseException:
+        staging.abort()
+        raise
+    return staging
+
+
+def slot_dir(images_dir):
+    """
+    Get the directory holding the active images. Images are kept in two
+    slots, and the "current" symlink in images_dir points at the active
+    one. Images installed before slots existed and pre-installed images
+    are used from images_dir directly.
+    """
+    current = os.path.join(images_dir, "current")
+    if os.path.islink(current):
+        return os.path.realpath(current)
+    return images_dir
+
+# How often the current thread holds the slot lock
+_slot_lock_depth = threading.local()
+
+@contextmanager
+def slot_lock(args):
+    """
+    Hold the lock of the slots for the with block. Background pre-staging,
+    upgrades and replacing images from zips all write the inactive slot.
+    The thread holding the lock can take it again.
+    """
+    depth = getattr(_slot_lock_depth, "value", 0)
+    with open(os.path.join(args.images_path, ".lock"), "w") if not depth else nullcontext() as lock:
+        if lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        _slot_lock_depth.value = depth + 1
+        try:
+            yield
+        finally:
+            _slot_lock_depth.value = depth
+
+def read_slot(args, slot):
+    """
+    :returns: what slot.json records about the images of a slot, or None
+              when the slot doesn't hold a complete set of images. For
+              every channel it has the "<channel>_datetime", and the
+              "<channel>_id" and "<channel>_ota" of the build, which are
+              None when they aren't known. "staged" is True until the slot
+              was switched to.
+    """
+    path = os.path.join(args.images_path, slot)
+    if not all(os.path.isfile(os.path.join(path, name)) for name in image_names):
+        return None
+    try:
+        with open(os.path.join(path, "slot.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def inactive_slot(args):
+    """
+    Get the slot that new images are staged in. Images from before slots
+    existed are moved to the first slot on the way.
+    """
+    current = os.path.join(args.images_path, "current")
+    if not os.path.islink(current):
+        cfg = tools.config.load(args)
+        path = os.path.join(args.images_path, slots[0])
+        os.makedirs(path, exist_ok=True)
+        for name in image_names:
+            if os.path.isfile(os.path.join(args.images_path, name)):
+                os.replace(os.path.join(args.images_path, name), os.path.join(path, name))
+        info = {"staged": False}
+        for channel in channels:
+            info[channel + "_datetime"] = int(cfg["waydroid"][channel + "_datetime"])
+            info[channel + "_id"] = None
+            info[channel + "_ota"] = cfg["waydroid"][channel + "_ota"]
+        write_slot(args, slots[0], info)
+        os.symlink(slots[0], current)
+    active = os.path.basename(os.path.realpath(current))
+    return slots[1] if active == slots[0] else slots[0]
+
+def prepare_slot(args, slot, channels_updated):
+    """
+    Clear the images of a slot that are about to be replaced, so the old,
+    new and active images don't all take up space at the same time.
+    """
+    path = os.path.join(args.images_path, slot)
+    os.makedirs(path, exist_ok=True)
+    with suppress(FileNotFoundError):
+        os.remove(os.path.join(path, "slot.json"))
+    for channel in channels_updated:
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(path, channel + ".img"))
+
+def write_slot(args, slot, info):
+    path = os.path.join(args.images_path, slot, "slot.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(path + ".tmp", path)
+
+def finish_slot(args, slot, builds):
+    """
+    Complete a slot with the active images of the channels that weren't
+    updated, and record the builds of its images and the channels they
+    are from.
+
+    :param builds: dict of channel to build entry ("id" and "datetime") of
+                   the images staged
+    """
+    active = slot_dir(args.images_path)
+    active_info = read_slot(args, os.path.basename(active)) or {}
+    path = os.path.join(args.images_path, slot)
+    info = {"staged": True}
+    cfg = tools.config.load(args)
+    for channel in channels:
+        key = channel + "_datetime"
+        if channel in builds:
+            info[key] = int(builds[channel]["datetime"])
+            info[channel + "_id"] = builds[channel]["id"]
+            info[channel + "_ota"] = cfg["waydroid"][channel + "_ota"]
+            continue
+        # Hardlink the unchanged image, the images are only ever replaced
+        # and mounted read-only, so the slots can share it
+        name = channel + ".img"
+        tmp = os.path.join(path, name + ".new")
+        with suppress(FileNotFoundError):
+            os.remove(tmp)
+        try:
+            os.link(os.path.join(active, name), tmp)
+        except OSError:
+            shutil.copyfile(os.path.join(active, name), tmp)
+        os.replace(tmp, os.path.join(path, name))
+        info[key] = int(cfg["waydroid"][key])
+        info[channel + "_id"] = active_info.get(channel + "_id")
+        info[channel + "_ota"] = active_info.get(channel + "_ota")
+    write_slot(args, slot, info)
+
+def switch_slot(args, slot):
+    """
+    Make the images of a slot the active ones. The container has to be
+    restarted to pick them up.
+    """
+    info = read_slot(args, slot)
+    if not info:
+        raise RuntimeError("No complete set of images in " + slot)
+    if info.get("staged"):
+        info["staged"] = False
+        write_slot(args, slot, info)
+    current = os.path.join(args.images_path, "current")
+    with suppress(FileNotFoundError):
+        os.remove(current + ".new")
+    os.symlink(slot, current + ".new")
+    os.replace(current + ".new", current)
+    cfg = tools.config.load(args)
+    for channel in channels:
+        cfg["waydroid"][channel + "_datetime"] = str(info[channel + "_datetime"])
+    tools.config.save(args, cfg)
+    remove_overlay(args)
+    logging.info("Switched to the images in " + slot)
+
+def previous_slot(args):
+    """
+    :returns: the slot holding the images from before the last upgrade, or
+              None when there are none (or they were replaced by a staged
+              update)
+    """
+    slot = inactive_slot(args)
+    info = read_slot(args, slot)
+    if not info or info.get("staged"):
+        return None
+    cfg = tools.config.load(args)
+    for channel in channels:
+        ota = cfg["waydroid"][channel + "_ota"]
+        # Images of another channel, from before switching channels
+        if info.get(channel + "_ota", ota) not in [ota, None]:
+            return None
+        # slot.json from before staged slots were marked
+        if "staged" not in info and \
+                info[channel + "_datetime"] > int(cfg["waydroid"][channel + "_datetime"]):
+            return None
+    return slot
+
+def ota_urls(cfg, channel):
+    """
+    :returns: the address of the channel file of a channel on its origin,
+              followed by the ones on its mirrors
+    """
+    return [cfg["waydroid"][channel + "_ota"]] + \
+        cfg["waydroid"].get(channel + "_ota_mirrors", "").split()
+
+def retrieve_channel(args, cfg, channel, offline=False):
+    """
+    Fetch the channel file of a channel, from the first of the origin and
+    its mirrors that answers.
+
+    :returns: status and content like helpers.http.retrieve()
+    """
+    for ota in ota_urls(cfg, channel):
+        request = helpers.http.retrieve_cached(args, ota, offline=offline)
+        if request[0] == 200:
             break
+        logging.debug("Failed to get {}, error: {}".format(ota, request[0]))
+    return request
+
+def image_mirrors(args, cfg, channel, build):
+    """
+    Find a build of a channel on its origin and mirrors, going by the build
+    id in their channel files. Mirrors can host the zips anywhere, like the
+    origin does.
 
-    vendor_ota = cfg["waydroid"]["vendor_ota"]
-    vendor_request = helpers.http.retrieve(vendor_ota)
-    if vendor_request[0] != 200:
+    :param build: the build entry of the channel response
+    :returns: the other addresses of the zip of the build
+    """
+    otas = ota_urls(cfg, channel)
+    if len(otas) < 2:
+        return []
+    mirrors = []
+    for ota, result in zip(otas, helpers.http.Probe(args, otas).all()):
+        if result is None or result[0] != 200:
+            logging.debug("Failed to get {}, error: {}".format(ota, result and result[0]))
+            continue
+        try:
+            responses = json.loads(result[1].decode('utf8'))["response"]
+        except (ValueError, KeyError):
+            logging.debug("Invalid channel file: " + ota)
+            continue
+        for other in responses:
+            url = other.get("url")
+            if other.get("id") == build["id"] and url and url != build["url"] and url not in mirrors:
+                mirrors.append(url)
+    return mirrors
+
+def known_builds(args, slot, builds):
+    """
+    Find builds that are on disk already, going by slot.json of the inactive
+    slot and the build ids in the verified-hash memo.
+
+    :param builds: dict of channel to build entry ("id" and "datetime")
+    :returns: (current, staged), the channels whose build is the active
+              image, and the ones whose build is staged in slot
+    """
+    info = read_slot(args, slot) or {}
+    cfg = tools.config.load(args)
+    current = []
+    staged = []
+    for channel, build in builds.items():
+        name = channel + ".img"
+        active = helpers.memo.get(args, os.path.join(slot_dir(args.images_path), name)) or {}
+        inactive = helpers.memo.get(args, os.path.join(args.images_path, slot, name)) or {}
+        if active.get("id") == build["id"]:
+            current.append(channel)
+        elif inactive.get("id") == build["id"] or \
+                (info.get(channel + "_id") == build["id"] and
+                 info.get(channel + "_ota") == cfg["waydroid"][channel + "_ota"]):
+            staged.append(channel)
+    return current, staged
+
+def remember_images(args, slot, builds):
+    """ Record the builds of freshly committed images in the memo. """
+    for channel, build in builds.items():
+        helpers.memo.put(args, os.path.join(args.images_path, slot, channel + ".img"),
+                 id=build["id"], datetime=int(build["datetime"]))
+
+def get_update(args, cfg, channel):
+    """
+    Get the newest build of a channel that is newer than the installed one.
+
+    :returns: the build entry of the channel response, or None when the
+              installed image is up to date
+    """
+    ota = cfg["waydroid"][channel + "_ota"]
+    request = retrieve_channel(args, cfg, channel)
+    if request[0] != 200:
         raise ValueError(
-            "Failed to get vendor OTA channel: {}, error: {}".format(vendor_ota, vendor_request[0]))
-    vendor_responses = json.loads(vendor_request[1].decode('utf8'))["response"]
-    if len(vendor_responses) < 1:
-        raise ValueError("No images found on vendor channel")
-
-    for vendor_response in vendor_responses:
-        if vendor_response['datetime'] > int(cfg["waydroid"]["vendor_datetime"]):
-            images_zip = helpers.http.download(
-                args, vendor_response['url'], vendor_response['filename'], cache=False)
-            logging.info("Validating vendor image")
-            with open(images_zip, 'rb') as f:
-                if sha256sum(f) != vendor_response['id']:
-                    with suppress(OSError):
-                        os.remove(images_zip)
-                    raise ValueError("Downloaded vendor image hash doesn't match, expected: {}".format(
-                        vendor_response['id']))
-                logging.info("Extracting to " + args.images_path)
-                with zipfile.ZipFile(f, 'r') as zip_ref:
-                    zip_ref.extractall(args.images_path)
-            cfg["waydroid"]["vendor_datetime"] = str(vendor_response['datetime'])
+            "Failed to get {} OTA channel: {}, error: {}".format(channel, ota, request[0]))
+    responses = json.loads(request[1].decode('utf8'))["response"]
+    if len(responses) < 1:
+        raise ValueError("No images found on {} channel".format(channel))
+
+    for response in responses:
+        if response['datetime'] > int(cfg["waydroid"][channel + "_datetime"]):
+            return response
+    return None
+
+
+def get(args, activate=True):
+    """
+    Update the system and vendor images from their OTA channels. Both
+    channels are fetched, downloaded and extracted concurrently into the
+    inactive slot, while the active images stay untouched.
+
+    :param activate: switch to the new images when both channels succeeded,
+                     otherwise the caller does so with switch_slot()
+    :returns: the slot holding the new images, or None when the installed
+              images are up to date
+    """
+    cfg = tools.config.load(args)
+    responses = {}
+    results = {}
+
+    def check(channel):
+        try:
+            responses[channel] = get_update(args, cfg, channel)
+        except BaseException as e:
+            responses[channel] = e
+
+    def stage(channel):
+        try:
+            response = responses[channel]
+            staging = None
+            try:
+                staging = delta_image(args, response, channel, cfg["waydroid"][channel + "_ota"],
+                                      dest, progress)
+            except Exception as e:
+                logging.warning("Delta update of the {} image failed, downloading the full image: {}".format(
+                    channel, e))
+            if staging:
+                results[channel] = (response, staging, None)
+            else:
+                results[channel] = (response, *download_image(args, response, channel,
+                                                              dest, progress))
+        except BaseException as e:
+            results[channel] = e
+
+    def run(target, channels):
+        threads = [threading.Thread(target=target, args=(channel,), daemon=True)
+                   for channel in channels]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so KeyboardInterrupt reaches us
+            while thread.is_alive():
+                thread.join(1)
+
+    run(check, channels)
+    errors = [result for result in responses.values() if isinstance(result, BaseException)]
+    if errors:
+        raise errors[0]
+    updated = [channel for channel in channels if responses[channel]]
+    if not updated:
+        return None
+
+    with slot_lock(args):
+        slot = inactive_slot(args)
+        dest = os.path.join(args.images_path, slot)
+
+        # Builds that are installed or were pre-staged already are kept
+        current, staged = known_builds(args, slot, {channel: responses[channel]
+                                                    for channel in updated})
+        if current:
+            for channel in current:
+                logging.info("The {} image is the newest build already".format(channel))
+                cfg["waydroid"][channel + "_datetime"] = str(responses[channel]['datetime'])
             tools.config.save(args, cfg)
-            os.remove(images_zip)
-            break
-    remove_overlay(args)
+            updated = [channel for channel in updated if channel not in current]
+            if not updated:
+                return None
+        builds = {channel: responses[channel] for channel in staged}
+        pending = [channel for channel in updated if channel not in builds]
+        if pending:
+            prepare_slot(args, slot, pending)
+            progress = helpers.http.Progress()
+            try:
+                run(stage, pending)
+            finally:
+                progress.stop()
+        else:
+            logging.info("Using the images staged in " + slot)
 
-def validate(args, channel, f):
+        errors = [result for result in results.values() if isinstance(result, BaseException)]
+        if errors:
+            for result in results.values():
+                if isinstance(result, tuple):
+                    result[1].abort()
+            raise errors[0]
+
+        for channel in pending:
+            response, staging, images_zip = results[channel]
+            staging.commit()
+            transcode(args, os.path.join(dest, channel + ".img"))
+            if images_zip:
+                helpers.http.release(args, images_zip)
+            builds[channel] = response
+        remember_images(args, slot, {channel: responses[channel] for channel in pending})
+        if pending:
+            finish_slot(args, slot, builds)
+        if activate:
+            switch_slot(args, slot)
+    return slot
+
+def validate(args, channel, chksum, name):
     # Verify that the zip comes from the channel
     cfg = tools.config.load(args)
     channel_url = cfg["waydroid"][channel]
-    channel_request = helpers.http.retrieve(channel_url)
-    if channel_request[0] != 200:
-        return False
-    channel_responses = json.loads(channel_request[1].decode('utf8'))["response"]
-    chksum = sha256sum(f)
-    for build in channel_responses:
-        if chksum == build['id']:
-            return True
-    logging.warning(f"Could not verify the image {f.name} against {channel_url}")
+    # The cached channel is usually recent enough to know the build
+    for offline in [True, False]:
+        channel_request = retrieve_channel(args, cfg, channel[:-len("_ota")], offline=offline)
+        if channel_request[0] != 200:
+            continue
+        channel_responses = json.loads(channel_request[1].decode('utf8'))["response"]
+        for build in channel_responses:
+            if chksum == build['id']:
+                return True
+    logging.warning(f"Could not verify the image {name} against {channel_url}")
     return False
 
 def replace(args, system_zip, system_time, vendor_zip, vendor_time):
     cfg = tools.config.load(args)
     args.images_path = cfg["waydroid"]["images_path"]
-    if os.path.exists(system_zip):
-        with open(system_zip, 'rb') as f:
-            if validate(args, "system_ota", f):
-                with zipfile.ZipFile(f, 'r') as zip_ref:
-                    zip_ref.extractall(args.images_path)
-                cfg["waydroid"]["system_datetime"] = str(system_time)
-            else:
-                logging.warning("Failed to validate update system image, ignoring")
-        os.remove(system_zip)
-    if os.path.exists(vendor_zip):
-        with open(vendor_zip, 'rb') as f:
-            if validate(args, "vendor_ota", f):
-                with zipfile.ZipFile(f, 'r') as zip_ref:
-                    zip_ref.extractall(args.images_path)
-                cfg["waydroid"]["vendor_datetime"] = str(vendor_time)
-            else:
-                logging.warning("Failed to validate update vendor image, ignoring")
-        os.remove(vendor_zip)
-    tools.config.save(args, cfg)
-    remove_overlay(args)
+    updates = [(channel, images_zip, datetime)
+               for channel, images_zip, datetime in [("system", system_zip, system_time),
+                                                     ("vendor", vendor_zip, vendor_time)]
+               if os.path.exists(images_zip)]
+    if not updates:
+        return
+    with slot_lock(args):
+        slot = inactive_slot(args)
+        dest = os.path.join(args.images_path, slot)
+        builds = {}
+        for channel, images_zip, datetime in updates:
+            # Validate before the slot is cleared, it holds the images to
+            # roll back to
+            progress = helpers.http.Progress("verify")
+            counter = progress.track()
+            counter[1] = os.path.getsize(images_zip)
+            sha256 = hashlib.sha256()
+            try:
+                with open(images_zip, 'rb') as f:
+                    for data in iter(lambda: f.read(helpers.http.chunk_size), b""):
+                        sha256.update(data)
+                        counter[0] += len(data)
+            finally:
+                progress.stop()
+            if not validate(args, channel + "_ota", sha256.hexdigest(), images_zip):
+                logging.warning("Failed to validate update {} image, ignoring".format(channel))
+                os.remove(images_zip)
+                continue
+
+            prepare_slot(args, slot, [channel])
+            stream = payload_stream(dest, images_zip, channel)
+            progress = helpers.http.Progress("extract")
+            counter = progress.track()
+            counter[1] = os.path.getsize(images_zip)
+            try:
+                with open(images_zip, 'rb') as f:
+                    for data in iter(lambda: f.read(helpers.http.chunk_size), b""):
+                        stream.update(data)
+                        counter[0] += len(data)
+                stream.finish()
+                progress.stop()
+                if stream.hexdigest() != sha256.hexdigest():
+                    raise ValueError("Update {} image changed while it was extracted".format(channel))
+                if stream.failed:
+                    stream.extract(images_zip)
+                stream.commit()
+                transcode(args, os.path.join(dest, channel + ".img"))
+                builds[channel] = {"id": stream.hexdigest(), "datetime": datetime}
+                remember_images(args, slot, {channel: builds[channel]})
+            finally:
+                progress.stop()
+                stream.abort()
+            os.remove(images_zip)
+        if builds:
+            finish_slot(args, slot, builds)
+            switch_slot(args, slot)
+
 
 def remove_overlay(args):
     if os.path.isdir(tools.config.defaults["overlay_rw"]):
@@ -159,10 +1251,62 @@ def make_prop(args, cfg, full_props_path):
             f.write(prop + "\n")
     os.chmod(full_props_path, 0o644)
 
+def rootfs_state(args, cfg, images_dir):
+    """
+    :returns: dict of what the rootfs is mounted from: the images, the
+              mount options and the hash of the props
+    """
+    state = {"images_dir": images_dir,
+             "mount_overlays": cfg["waydroid"]["mount_overlays"],
+             "loop_direct_io": cfg["waydroid"]["loop_direct_io"]}
+    for name in image_names:
+        st = os.stat(os.path.join(images_dir, name))
+        state[name] = [st.st_dev, st.st_ino, st.st_mtime_ns]
+    with open(args.work + "/waydroid.prop", "rb") as f:
+        state["props"] = hashlib.sha256(f.read()).hexdigest()
+    return state
+
+def warm_rootfs(args, cfg, images_dir):
+    """
+    :returns: True if the rootfs is still mounted from a previous session,
+              and from the same images with the same options and props
+    """
+    if cfg["waydroid"]["warm_rootfs"] != "True":
+        return False
+    try:
+        with open(rootfs_state_path(args)) as f:
+            mounted = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return mounted == rootfs_state(args, cfg, images_dir) and \
+        helpers.mount.ismount(tools.config.defaults["rootfs"])
+
+def rootfs_state_path(args):
+    return args.work + "/rootfs_state.json"
+
 def mount_rootfs(args, images_dir, session):
     cfg = tools.config.load(args)
-    helpers.mount.mount(args, images_dir + "/system.img",
-                        tools.config.defaults["rootfs"], umount=True)
+    images_dir = slot_dir(images_dir)
+    make_prop(args, session, args.work + "/waydroid.prop")
+    if warm_rootfs(args, cfg, images_dir):
+        logging.info("Reusing the rootfs of the previous session")
+        return
+    with suppress(FileNotFoundError):
+        os.remove(rootfs_state_path(args))
+
+    direct_io = cfg["waydroid"]["loop_direct_io"] == "True"
+    if direct_io:
+        def image(name):
+            return helpers.mount.loop_device(images_dir + "/" + name)
+    else:
+        def image(name):
+            return nullcontext(images_dir + "/" + name)
+        # Runs in the background, while the images are mounted and Android
+        # starts. Direct I/O bypasses the page cache it reads into.
+        helpers.readahead.prefetch(args, images_dir, image_names)
+
+    with image("system.img") as source:
+        helpers.mount.mount(args, source, tools.config.defaults["rootfs"], umount=True)
     if cfg["waydroid"]["mount_overlays"] == "True":
         try:
             helpers.mount.mount_overlay(args, [tools.config.defaults["overlay"],
@@ -175,8 +1319,8 @@ def mount_rootfs(args, images_dir, session):
             tools.config.save(args, cfg)
             logging.warning("Mounting overlays failed. The feature has been disabled.")
 
-    helpers.mount.mount(args, images_dir + "/vendor.img",
-                           tools.config.defaults["rootfs"] + "/vendor")
+    with image("vendor.img") as source:
+        helpers.mount.mount(args, source, tools.config.defaults["rootfs"] + "/vendor")
     if cfg["waydroid"]["mount_overlays"] == "True":
         helpers.mount.mount_overlay(args, [tools.config.defaults["overlay"] + "/vendor",
                                            tools.config.defaults["rootfs"] + "/vendor"],
@@ -196,9 +1340,18 @@ def mount_rootfs(args, images_dir, session):
             helpers.mount.bind(
                 args, "/vendor/odm", tools.config.defaults["rootfs"] + "/odm_extra")
 
-    make_prop(args, session, args.work + "/waydroid.prop")
     helpers.mount.bind_file(args, args.work + "/waydroid.prop",
                             tools.config.defaults["rootfs"] + "/vendor/waydroid.prop")
 
-def umount_rootfs(args):
-    helpers.mount.umount_all(args, tools.config.defaults["rootfs"])
+    cfg = tools.config.load(args)
+    if cfg["waydroid"]["warm_rootfs"] == "True":
+        with open(rootfs_state_path(args), "w") as f:
+            json.dump(rootfs_state(args, cfg, images_dir), f)
+
+def umount_rootfs(args, detach=False):
+    """
+    :param detach: detach the mounts lazily, see helpers.mount.umount_all()
+    """
+    with suppress(FileNotFoundError):
+        os.remove(rootfs_state_path(args))
+    helpers.mount.umount_all(args, tools.config.defaults["rootfs"], detach)
@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import ctypes
+import ctypes.util
+import os
+import threading
+
+_libc = None
+_lock = threading.Lock()
+
+def load():
+    """
+    Load the C library once, with the prototypes of the functions that are
+    called through ctypes. syscall() is variadic and has none.
+
+    :returns: the ctypes handle of the C library
+    """
+    global _libc
+    with _lock:
+        if _libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
+                                   ctypes.c_ulong, ctypes.c_char_p]
+            libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+            libc.mmap.restype = ctypes.c_void_p
+            libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                                  ctypes.c_int, ctypes.c_int, ctypes.c_long]
+            libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                     ctypes.POINTER(ctypes.c_ubyte)]
+            _libc = libc
+    return _libc
+
+def check(ret, call):
+    """
+    Raise an OSError with errno when a C library call failed.
+
+    :param ret: return value of the call, negative on failure
+    :param call: name of the call for the error message
+    :returns: ret
+    """
+    if ret < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, "{}: {}".format(call, os.strerror(error)))
+    return ret
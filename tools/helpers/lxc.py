@@ -397,13 +397,83 @@ def setup_host_perms(args):
     for filename in copy_list:
         shutil.copy(filename, tools.config.defaults["host_perms"])
 
+# Init process of the running container, (pid, start time), see status()
+container_init = None
+
+def process_start(pid):
+    """
+    :returns: start time of a process, to tell it from a later process
+              with the same pid, or None if it is gone or a zombie
+    """
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return None if fields[0] in ["Z", "X"] else fields[19]
+
+def cgroup_state(pid):
+    """
+    Read the freezer state of the cgroup of a process, from the cgroup v1
+    freezer or the cgroup v2 cgroup.freeze and cgroup.events files.
+
+    :returns: "RUNNING", "FREEZING" or "FROZEN", None if there is no freezer
+    """
+    with open("/proc/{}/cgroup".format(pid)) as f:
+        hierarchies = [line.split(":", 2) for line in f.read().splitlines()]
+    for _, controllers, path in hierarchies:
+        if "freezer" in controllers.split(","):
+            with open("/sys/fs/cgroup/freezer{}/freezer.state".format(path)) as f:
+                state = f.read().strip()
+            return "RUNNING" if state == "THAWED" else state
+    for hierarchy, controllers, path in hierarchies:
+        if hierarchy != "0" or controllers:
+            continue
+        for root in ["/sys/fs/cgroup", "/sys/fs/cgroup/unified"]:
+            try:
+                with open(root + path + "/cgroup.events") as f:
+                    events = dict(line.split() for line in f.read().splitlines())
+                with open(root + path + "/cgroup.freeze") as f:
+                    freeze = f.read().strip()
+            except OSError:
+                continue
+            if events.get("frozen") == "1":
+                return "FROZEN"
+            return "FREEZING" if freeze == "1" else "RUNNING"
+    return None
+
 def status(args):
-    command = ["lxc-info", "-P", tools.config.defaults["lxc"], "-n", "waydroid", "-sH"]
+    """
+    Get the state of the container. Once lxc-info reported it running, it
+    is read without forking from the init process and its cgroup, until
+    init is gone. Stopping is confirmed with lxc-info again, as LXC still
+    cleans up after init exited.
+    """
+    global container_init
+    if container_init is not None:
+        pid, start = container_init
+        try:
+            if process_start(pid) == start:
+                state = cgroup_state(pid)
+                if state:
+                    return state
+        except (OSError, IndexError, ValueError) as e:
+            logging.debug("Fast LXC status failed: {}".format(e))
+        container_init = None
+
+    command = ["lxc-info", "-P", tools.config.defaults["lxc"], "-n", "waydroid", "-s", "-p", "-H"]
     try:
-        return tools.helpers.run.user(args, command, output_return=True).strip()
+        output = tools.helpers.run.user(args, command, output_return=True).split()
     except Exception:
         logging.info("Couldn't get LXC status. Assuming STOPPED.")
         return "STOPPED"
+    if not output:
+        return "STOPPED"
+    state = output[0]
+    if state in ["RUNNING", "FROZEN"] and len(output) > 1:
+        with suppress(OSError, IndexError):
+            pid = int(output[1])
+            start = process_start(pid)
+            if start:
+                container_init = (pid, start)
+    return state
 
 def wait_for_running(args):
     lxc_status = status(args)
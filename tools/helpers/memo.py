@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+import os
+import threading
+import time
+
+# Memo of verified files: hashes of downloaded zips, and the builds of
+# installed images, so unchanged files don't have to be hashed again
+
+# Entries kept in the memo
+size = 32
+# Downloads finishing at the same time update the memo
+_lock = threading.Lock()
+
+def memo_path(args):
+    return args.work + "/verified.json"
+
+def key(path):
+    st = os.stat(path)
+    return "{}:{}:{}:{}".format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def get(args, path):
+    """
+    Look up what is known about a file that was verified before. Files are
+    identified by device, inode, size and mtime, so any change to a file, or
+    a different file in its place, doesn't match.
+
+    :returns: dict with the "sha256" of the file and/or the "id" and
+              "datetime" of the build it belongs to, or None
+    """
+    try:
+        path_key = key(path)
+        with open(memo_path(args)) as f:
+            return json.load(f).get(path_key)
+    except (OSError, ValueError):
+        return None
+
+def put(args, path, **info):
+    """
+    Remember the hash or build of a verified file, see get().
+    """
+    with _lock:
+        try:
+            with open(memo_path(args)) as f:
+                memo = json.load(f)
+        except (OSError, ValueError):
+            memo = {}
+        info["used"] = time.time()
+        memo[key(path)] = info
+        # Stale keys never match again, drop the oldest entries
+        for old in sorted(memo, key=lambda old: memo[old]["used"])[:-size]:
+            del memo[old]
+        tmp = "{}.{}.tmp".format(memo_path(args), os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(memo, f)
+        os.replace(tmp, memo_path(args))
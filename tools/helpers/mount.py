@@ -1,24 +1,247 @@
 # Copyright 2021 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import errno
+import fcntl
+import logging
 import os
+import re
+import select
+import struct
+import threading
 import tools.helpers.run
+from tools.helpers import libc
+from contextlib import contextmanager
 from tools.helpers.version import versiontuple, kernel_version
 
+# From linux/loop.h
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_SET_BLOCK_SIZE = 0x4C09
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_DIRECT_IO = 16
+# struct loop_info64
+LOOP_INFO64 = "QQQQQIIII64s64s32sQQ"
+# struct loop_config: fd, block_size, loop_info64, reserved
+LOOP_CONFIG = "=II" + LOOP_INFO64 + "64x"
+
+# From linux/mount.h
+MS_RDONLY = 1
+MS_BIND = 4096
+MNT_DETACH = 2
+# The new mount API of Linux 5.2, numbered the same on all architectures
+SYS_MOVE_MOUNT = 429
+SYS_FSOPEN = 430
+SYS_FSCONFIG = 431
+SYS_FSMOUNT = 432
+FSOPEN_CLOEXEC = 1
+FSCONFIG_SET_FLAG = 0
+FSCONFIG_SET_STRING = 1
+FSCONFIG_CMD_CREATE = 6
+FSMOUNT_CLOEXEC = 1
+MOUNT_ATTR_RDONLY = 1
+MOVE_MOUNT_F_EMPTY_PATH = 4
+AT_FDCWD = -100
+# File system magic numbers: (offset, bytes, type)
+FS_MAGICS = [(1080, b"\x53\xef", "ext4"),
+             (1024, b"\xe2\xe1\xf5\xe0", "erofs"),
+             (0, b"hsqs", "squashfs")]
+
+
+class MountEntry:
+    """
+    A line of /proc/self/mountinfo, see proc(5).
+    """
+    def __init__(self, line):
+        fields = line.split()
+        separator = fields.index("-", 6)
+        self.id = int(fields[0])
+        self.parent_id = int(fields[1])
+        self.device = fields[2]
+        self.root = unescape(fields[3])
+        self.mountpoint = unescape(fields[4])
+        self.options = fields[5]
+        # shared:N, master:N, propagate_from:N or unbindable
+        self.propagation = fields[6:separator]
+        self.fstype = fields[separator + 1]
+        self.source = unescape(fields[separator + 2])
+        self.super_options = fields[separator + 3] if len(fields) > separator + 3 else ""
+        # Mount points that were deleted (#545)
+        if self.mountpoint.endswith(" (deleted)"):
+            self.mountpoint = self.mountpoint[:-len(" (deleted)")]
+
+
+def unescape(path):
+    """
+    Undo the octal escapes of spaces, tabs, newlines and backslashes in
+    mount table paths.
+    """
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), path)
+
+
+class MountTable:
+    """
+    Index of the mount table, parsed from /proc/self/mountinfo. The file is
+    kept open and only read again after the kernel signalled a change of
+    the mount table with POLLPRI. A forked child opens the file again,
+    since sharing the open file would share the change events.
+    """
+    def __init__(self, source="/proc/self/mountinfo"):
+        self.source = source
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+        self.poll = None
+        self.entries = []
+        self.mountpoints = {}
+        self.sources = set()
+
+    def changed(self):
+        if self.file is None or self.pid != os.getpid():
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.source, "rb")
+            self.pid = os.getpid()
+            self.poll = None
+            # Only proc files signal changes
+            if self.source.startswith("/proc/"):
+                self.poll = select.poll()
+                self.poll.register(self.file, select.POLLPRI | select.POLLERR)
+            return True
+        if self.poll is None:
+            return True
+        return bool(self.poll.poll(0))
+
+    def refresh(self):
+        """
+        Parse the mount table again, if it changed since the last time.
+        """
+        with self.lock:
+            if not self.changed():
+                return
+            self.file.seek(0)
+            lines = self.file.read().decode("utf-8", "surrogateescape").splitlines()
+            try:
+                self.entries = [MountEntry(line) for line in lines if line]
+            except (ValueError, IndexError):
+                raise RuntimeError("Failed to parse " + self.source)
+            # The last mount on a mount point is the visible one
+            self.mountpoints = {entry.mountpoint: entry for entry in self.entries}
+            self.sources = {entry.source for entry in self.entries}
+
+    def ismount(self, path):
+        self.refresh()
+        return path in self.mountpoints or path in self.sources
+
+    def under(self, prefix):
+        """
+        :returns: list of the entries mounted on prefix or below it
+        """
+        self.refresh()
+        return [entry for entry in self.entries
+                if entry.mountpoint == prefix or entry.mountpoint.startswith(prefix.rstrip("/") + "/")]
+
+
+table = MountTable()
+
 
 def ismount(folder):
     """
     Ismount() implementation, that works for mount --bind.
     Workaround for: https://bugs.python.org/issue29707
     """
-    folder = os.path.realpath(os.path.realpath(folder))
-    with open("/proc/mounts", "r") as handle:
-        for line in handle:
-            words = line.split()
-            if len(words) >= 2 and words[1] == folder:
-                return True
-            if words[0] == folder:
-                return True
-    return False
+    return table.ismount(os.path.realpath(folder))
+
+
+def _encode(value):
+    return None if value is None else os.fsencode(value)
+
+
+def sys_mount(source, target, fstype=None, flags=0, data=None):
+    """
+    Call mount(2) directly, instead of forking mount(8).
+    """
+    logging.debug("% mount(2) {} {} {} {}".format(source, target, fstype, data or ""))
+    libc.check(libc.load().mount(_encode(source), _encode(target), _encode(fstype),
+                        flags, _encode(data)), "mount")
+
+
+def sys_umount(target, flags=0):
+    logging.debug("% umount2(2) " + target)
+    libc.check(libc.load().umount2(_encode(target), flags), "umount2")
+
+
+def fs_mount(fstype, source, target, options, readonly):
+    """
+    Mount a file system with fsopen(2), fsconfig(2), fsmount(2) and
+    move_mount(2), which don't limit the size of the options like mount(2).
+
+    :param options: list of "key=value" and flag options
+    """
+    logging.debug("% fsmount(2) {} {} {} {}".format(fstype, source, target, ",".join(options)))
+    syscall = libc.load().syscall
+    fsfd = libc.check(syscall(SYS_FSOPEN, _encode(fstype), FSOPEN_CLOEXEC), "fsopen")
+    try:
+        for option in ["source=" + source] + options + (["ro"] if readonly else []):
+            key, _, value = option.partition("=")
+            if value:
+                libc.check(syscall(SYS_FSCONFIG, fsfd, FSCONFIG_SET_STRING, _encode(key),
+                               _encode(value), 0), "fsconfig " + key)
+            else:
+                libc.check(syscall(SYS_FSCONFIG, fsfd, FSCONFIG_SET_FLAG, _encode(key), None, 0),
+                       "fsconfig " + key)
+        libc.check(syscall(SYS_FSCONFIG, fsfd, FSCONFIG_CMD_CREATE, None, None, 0), "fsconfig")
+        mntfd = libc.check(syscall(SYS_FSMOUNT, fsfd, FSMOUNT_CLOEXEC,
+                               MOUNT_ATTR_RDONLY if readonly else 0), "fsmount")
+    finally:
+        os.close(fsfd)
+    try:
+        libc.check(syscall(SYS_MOVE_MOUNT, mntfd, b"", AT_FDCWD, _encode(target),
+                       MOVE_MOUNT_F_EMPTY_PATH), "move_mount")
+    finally:
+        os.close(mntfd)
+
+
+def detect_fstype(path):
+    """
+    :returns: type of the file system in an image or block device
+    """
+    with open(path, "rb") as f:
+        head = f.read(2048)
+    for offset, magic, fstype in FS_MAGICS:
+        if head[offset:offset + len(magic)] == magic:
+            return fstype
+    raise OSError(errno.EINVAL, "Unknown file system in " + path)
+
+
+def _native_mount(source, destination, mount_type, options, readonly):
+    """
+    Mount without forking, for mount(). Images are attached to a loop device
+    first, like mount(8) does.
+    """
+    if mount_type is None and os.path.isfile(source):
+        fstype = detect_fstype(source)
+        with loop_device(source, direct_io=False) as device:
+            _native_mount(device, destination, fstype, options, readonly)
+        return
+    fstype = mount_type or detect_fstype(source)
+    try:
+        fs_mount(fstype, source, destination, options, readonly)
+    except OSError as e:
+        # Kernels before 5.2
+        if e.errno != errno.ENOSYS:
+            raise
+        sys_mount(source, destination, fstype, MS_RDONLY if readonly else 0,
+                  ",".join(options) or None)
+
+
+def makedirs(path):
+    logging.debug("% mkdir -p " + path)
+    os.makedirs(path, exist_ok=True)
 
 
 def bind(args, source, destination, create_folders=True, umount=False):
@@ -38,13 +261,17 @@ def bind(args, source, destination, create_folders=True, umount=False):
         if os.path.exists(path):
             continue
         if create_folders:
-            tools.helpers.run.user(args, ["mkdir", "-p", path])
+            makedirs(path)
         else:
             raise RuntimeError("Mount failed, folder does not exist: " +
                                path)
 
     # Actually mount the folder
-    tools.helpers.run.user(args, ["mount", "-o", "bind", source, destination])
+    try:
+        sys_mount(source, destination, flags=MS_BIND)
+    except OSError as e:
+        logging.debug("Falling back to mount(8): {}".format(e))
+        tools.helpers.run.user(args, ["mount", "-o", "bind", source, destination])
 
     # Verify, that it has worked
     if not ismount(destination):
@@ -65,50 +292,79 @@ def bind_file(args, source, destination, create_folders=False):
         if create_folders:
             dir = os.path.dirname(destination)
             if not os.path.isdir(dir):
-                tools.helpers.run.user(args, ["mkdir", "-p", dir])
+                makedirs(dir)
 
-        tools.helpers.run.user(args, ["touch", destination])
+        logging.debug("% touch " + destination)
+        open(destination, "a").close()
 
     # Mount
-    tools.helpers.run.user(args, ["mount", "-o", "bind", source,
-                                destination])
-
-
-def umount_all_list(prefix, source="/proc/mounts"):
-    """
-    Parses `/proc/mounts` for all folders beginning with a prefix.
-    :source: can be changed for testcases
-    :returns: a list of folders, that need to be umounted
-    """
-    ret = []
-    prefix = os.path.realpath(prefix)
-    with open(source, "r") as handle:
-        for line in handle:
-            words = line.split()
-            if len(words) < 2:
-                raise RuntimeError("Failed to parse line in " + source + ": " +
-                                   line)
-            mountpoint = words[1]
-            if mountpoint.startswith(prefix):
-                # Remove "\040(deleted)" suffix (#545)
-                deleted_str = r"\040(deleted)"
-                if mountpoint.endswith(deleted_str):
-                    mountpoint = mountpoint[:-len(deleted_str)]
-                ret.append(mountpoint)
-    ret.sort(reverse=True)
-    return ret
-
-
-def umount_all(args, folder):
-    """
-    Umount all folders, that are mounted inside a given folder.
-    """
-    all_list = umount_all_list(folder)
-    for mountpoint in all_list:
-        tools.helpers.run.user(args, ["umount", mountpoint])
-    for mountpoint in all_list:
-        if ismount(mountpoint):
-            raise RuntimeError("Failed to umount: " + mountpoint)
+    try:
+        sys_mount(source, destination, flags=MS_BIND)
+    except OSError as e:
+        logging.debug("Falling back to mount(8): {}".format(e))
+        tools.helpers.run.user(args, ["mount", "-o", "bind", source,
+                                    destination])
+
+
+def umount_all(args, folder, detach=False):
+    """
+    Umount all folders, that are mounted inside a given folder. A mount is
+    unmounted after the mounts on top of it and inside it, going by the
+    mount tree, and independent subtrees are unmounted at the same time.
+    :param detach: detach the mounts lazily, without waiting until they are
+                   no longer in use.
+    """
+    entries = table.under(os.path.realpath(folder))
+    ids = {entry.id for entry in entries}
+    order = {entry.id: i for i, entry in enumerate(entries)}
+    children = {}
+    for entry in entries:
+        parent = entry.parent_id if entry.parent_id in ids else None
+        children.setdefault(parent, []).append(entry)
+
+    def umount(entry):
+        try:
+            sys_umount(entry.mountpoint, MNT_DETACH if detach else 0)
+        except OSError as e:
+            logging.debug("Falling back to umount(8): {}".format(e))
+            tools.helpers.run.user(args, ["umount", *(["-l"] if detach else []),
+                                          entry.mountpoint], check=False)
+
+    def hides(entry, other):
+        # Mounted later on the same folder or on a folder above
+        return order[entry.id] > order[other.id] and \
+            (other.mountpoint + "/").startswith(entry.mountpoint.rstrip("/") + "/")
+
+    def teardown(entry):
+        teardown_siblings(children.get(entry.id, []))
+        umount(entry)
+
+    def teardown_siblings(entries):
+        # Mounts that hide others have to go first, so those can be reached
+        on_top = [entry for entry in entries
+                  if any(hides(entry, other) for other in entries if other is not entry)]
+        if on_top:
+            teardown_siblings(on_top)
+        teardown_all([entry for entry in entries if entry not in on_top])
+
+    def teardown_all(entries):
+        threads = [threading.Thread(target=teardown, args=(entry,)) for entry in entries[1:]]
+        for thread in threads:
+            thread.start()
+        try:
+            if entries:
+                teardown(entries[0])
+        finally:
+            for thread in threads:
+                thread.join()
+
+    teardown_siblings(children.get(None, []))
+
+    # Verify once at the end
+    table.refresh()
+    for entry in table.entries:
+        if entry.id in ids:
+            raise RuntimeError("Failed to umount: " + entry.mountpoint)
 
 def mount(args, source, destination, create_folders=True, umount=False,
           readonly=True, mount_type=None, options=None, force=True):
@@ -128,7 +384,7 @@ def mount(args, source, destination, create_folders=True, umount=False,
     # Check/create folders
     if not os.path.exists(destination):
         if create_folders:
-            tools.helpers.run.user(args, ["mkdir", "-p", destination])
+            makedirs(destination)
         else:
             raise RuntimeError("Mount failed, folder does not exist: " +
                             destination)
@@ -145,7 +401,11 @@ def mount(args, source, destination, create_folders=True, umount=False,
         extra_args.extend(["-o", ",".join(opt_args)])
 
     # Actually mount the folder
-    tools.helpers.run.user(args, ["mount", *extra_args, source, destination])
+    try:
+        _native_mount(source, destination, mount_type, options or [], readonly)
+    except OSError as e:
+        logging.debug("Falling back to mount(8): {}".format(e))
+        tools.helpers.run.user(args, ["mount", *extra_args, source, destination])
 
     # Verify, that it has worked
     if not ismount(destination):
@@ -171,10 +431,140 @@ def mount_overlay(args, lower_dirs, destination, upper_dir=None, work_dir=None,
     for dir_path in dirs:
         if not os.path.exists(dir_path):
             if create_folders:
-                tools.helpers.run.user(args, ["mkdir", "-p", dir_path])
+                makedirs(dir_path)
             else:
                 raise RuntimeError("Mount failed, folder does not exist: " +
                                    dir_path)
 
     mount(args, "overlay", destination, mount_type="overlay", options=options,
           readonly=readonly, create_folders=create_folders, force=True)
+
+
+def logical_block_size(path):
+    """
+    :returns: logical block size of the device a file is stored on, 512 if
+              it can't be found out
+    """
+    st = os.stat(path)
+    sysfs = os.path.realpath("/sys/dev/block/{}:{}".format(os.major(st.st_dev),
+                                                          os.minor(st.st_dev)))
+    # Partitions have no queue directory, their disk has
+    for queue in [sysfs + "/queue", os.path.dirname(sysfs) + "/queue"]:
+        try:
+            with open(queue + "/logical_block_size") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            pass
+    return 512
+
+
+def fs_block_size(path):
+    """
+    :returns: smallest block size the file system in an image can be read
+              with, 512 if it isn't known
+    """
+    with open(path, "rb") as f:
+        head = f.read(2048)
+    try:
+        fstype = detect_fstype(path)
+    except OSError:
+        return 512
+    if fstype == "ext4":
+        # s_log_block_size of the superblock
+        return 1024 << struct.unpack_from("<I", head, 1024 + 24)[0]
+    if fstype == "erofs":
+        # blkszbits of the superblock
+        return 1 << head[1024 + 12]
+    # squashfs reads in 1 KiB device blocks
+    return 1024
+
+
+def _loop_configure(loop_fd, backing_fd, path, flags, block_size):
+    info = [0, 0, 0, 0, 0, 0, 0, 0, flags, os.fsencode(path)[-63:], b"", b"", 0, 0]
+    try:
+        fcntl.ioctl(loop_fd, LOOP_CONFIGURE,
+                    struct.pack(LOOP_CONFIG, backing_fd, block_size, *info))
+        return
+    except OSError as e:
+        # LOOP_CONFIGURE is new in Linux 5.8
+        if e.errno not in [errno.EINVAL, errno.ENOTTY]:
+            raise
+    fcntl.ioctl(loop_fd, LOOP_SET_FD, backing_fd)
+    try:
+        fcntl.ioctl(loop_fd, LOOP_SET_STATUS64,
+                    struct.pack("=" + LOOP_INFO64, *info[:8],
+                                flags & ~LO_FLAGS_DIRECT_IO, *info[9:]))
+        if flags & LO_FLAGS_DIRECT_IO:
+            fcntl.ioctl(loop_fd, LOOP_SET_BLOCK_SIZE, block_size)
+            fcntl.ioctl(loop_fd, LOOP_SET_DIRECT_IO, 1)
+    except OSError:
+        fcntl.ioctl(loop_fd, LOOP_CLR_FD, 0)
+        raise
+
+
+@contextmanager
+def loop_device(path, direct_io=True):
+    """
+    Attach a file to a free read-only loop device, which reads the file with
+    direct I/O so its pages aren't cached twice, once for the file and once
+    for the file system on the loop device. Falls back to buffered I/O when
+    the file system of the file doesn't support it. The loop device goes
+    away when it is unmounted again, so it has to be mounted in the with
+    block.
+
+    :returns: path of the loop device
+    """
+    backing_fd = None
+    if direct_io:
+        try:
+            backing_fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            logging.debug("No direct I/O for {}: {}".format(path, e))
+            direct_io = False
+    if backing_fd is None:
+        backing_fd = os.open(path, os.O_RDONLY)
+    flags = LO_FLAGS_READ_ONLY | LO_FLAGS_AUTOCLEAR
+    block_size = 512
+    if direct_io:
+        # Direct I/O needs the block size of the backing device, but the
+        # file system can't be mounted on a device with bigger blocks than
+        # its own. The kernel falls back to buffered I/O with 512.
+        block_size = logical_block_size(path)
+        if block_size > fs_block_size(path):
+            logging.debug("{} has smaller blocks than its device, no direct I/O".format(path))
+            block_size = 512
+    ctl_fd = os.open("/dev/loop-control", os.O_RDWR)
+    loop_fd = None
+    try:
+        while True:
+            device = "/dev/loop{}".format(fcntl.ioctl(ctl_fd, LOOP_CTL_GET_FREE))
+            loop_fd = os.open(device, os.O_RDONLY)
+            try:
+                _loop_configure(loop_fd, backing_fd, path,
+                                flags | (LO_FLAGS_DIRECT_IO if direct_io else 0), block_size)
+                break
+            except OSError as e:
+                os.close(loop_fd)
+                loop_fd = None
+                # Another process took the device in the meantime
+                if e.errno == errno.EBUSY:
+                    continue
+                if not direct_io:
+                    raise
+                logging.debug("No direct I/O for {}: {}".format(path, e))
+                direct_io = False
+                block_size = 512
+        try:
+            with open("/sys/block/{}/loop/dio".format(os.path.basename(device))) as f:
+                direct_io = f.read().strip() == "1"
+        except OSError:
+            pass
+        logging.debug("Attached {} to {}{}".format(
+            path, device, " with direct I/O" if direct_io else ""))
+        yield device
+    finally:
+        # The device stays attached as long as it is mounted
+        if loop_fd is not None:
+            os.close(loop_fd)
+        os.close(ctl_fd)
+        os.close(backing_fd)
@@ -0,0 +1,212 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import ctypes
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+import tools.config
+from tools.helpers import libc
+
+# Profile of the image ranges read during boot, in the work directory, since
+# pre-installed images are usually on a read-only file system
+profile_name = "readahead.json"
+# Ranges closer than this are read as one, seeking costs more than reading
+merge_gap = 256 * 1024
+# mincore() is called on windows of this size, so 32 bit hosts can map them
+window_size = 128 * 1024 * 1024
+# Seconds between samples of the page cache while recording
+sample_interval = 5
+# Recording ends when the page cache stopped growing for this many samples,
+# but not before min_record seconds and no later than max_record seconds
+stable_samples = 3
+min_record = 30
+max_record = 300
+
+def resident(path):
+    """
+    Find the parts of a file that are in the page cache, with mincore(2).
+
+    :returns: list of [offset, length] byte ranges
+    """
+    page = mmap.PAGESIZE
+    ranges = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        for window in range(0, size, window_size):
+            length = min(window_size, size - window)
+            addr = libc.load().mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, window)
+            if addr in (None, ctypes.c_void_p(-1).value):
+                raise OSError(ctypes.get_errno(), "mmap failed: " + os.strerror(ctypes.get_errno()))
+            try:
+                vec = (ctypes.c_ubyte * ((length + page - 1) // page))()
+                libc.check(libc.load().mincore(addr, length, vec), "mincore")
+            finally:
+                libc.load().munmap(addr, length)
+            for i, flags in enumerate(vec):
+                if not flags & 1:
+                    continue
+                offset = window + i * page
+                if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                    ranges[-1][1] += page
+                else:
+                    ranges.append([offset, page])
+    finally:
+        os.close(fd)
+    return ranges
+
+def cached(paths):
+    """
+    :returns: how many bytes of the files are in the page cache
+    """
+    total = 0
+    for path in paths:
+        try:
+            total += sum(length for _, length in resident(path))
+        except OSError as e:
+            logging.debug("Failed to check the page cache of {}: {}".format(path, e))
+    return total
+
+def merge(ranges):
+    """
+    Join ranges that are less than merge_gap apart.
+    """
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset - (merged[-1][0] + merged[-1][1]) < merge_gap:
+            merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+        else:
+            merged.append([offset, length])
+    return merged
+
+def image_key(cfg, image, path):
+    """
+    :returns: key that changes with the build of an image
+    """
+    channel = os.path.basename(image)[:-len(".img")]
+    return "{}:{}".format(cfg["waydroid"].get(channel + "_datetime", "0"), os.path.getsize(path))
+
+def profile_path(args):
+    return os.path.join(args.work, profile_name)
+
+def load_profile(args):
+    """
+    :returns: dict of image path to the build key and ranges of the image
+    """
+    try:
+        with open(profile_path(args)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def can_save(args):
+    """
+    :returns: True when a recorded profile can be saved. Recording drops
+              the cached pages of the images, which is only worth it then.
+    """
+    try:
+        with open(profile_path(args), "a"):
+            return True
+    except OSError as e:
+        logging.debug("Can't save a boot readahead profile: {}".format(e))
+        return False
+
+def prefetch(args, images_dir, images):
+    """
+    Read the ranges of the images that were used during an earlier boot
+    into the page cache, in the background, in offset order. Images
+    without a profile for their current build get one recorded during this
+    boot instead.
+
+    :param images_dir: directory with the images
+    :param images: names of the images, like "system.img"
+    """
+    cfg = tools.config.load(args)
+    if cfg["waydroid"]["boot_readahead"] != "True":
+        return
+    profile = load_profile(args)
+    record = []
+    for image in images:
+        path = os.path.realpath(os.path.join(images_dir, image))
+        entry = profile.get(path)
+        if not os.path.isfile(path):
+            continue
+        if entry and entry["key"] == image_key(cfg, image, path):
+            threading.Thread(target=read_ranges, args=(path, entry["ranges"]), daemon=True).start()
+        else:
+            record.append(image)
+    if record and can_save(args):
+        threading.Thread(target=record_profile, args=(args, images_dir, record), daemon=True).start()
+
+def read_ranges(path, ranges):
+    start = time.monotonic()
+    total = 0
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        logging.debug("Readahead of {} failed: {}".format(path, e))
+        return
+    try:
+        for offset, length in ranges:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+            total += length
+    except OSError as e:
+        logging.debug("Readahead of {} failed: {}".format(path, e))
+    finally:
+        os.close(fd)
+    logging.debug("Read ahead {} MB of {} in {:.1f}s".format(
+        round(total / 1000000), path, time.monotonic() - start))
+
+def record_profile(args, images_dir, images):
+    """
+    Record which parts of the images are read during a boot, by sampling
+    the page cache until it stops growing.
+    """
+    cfg = tools.config.load(args)
+    paths = {image: os.path.realpath(os.path.join(images_dir, image)) for image in images}
+    keys = {image: image_key(cfg, image, path) for image, path in paths.items()}
+    # Start from an empty page cache, so only what the boot reads is seen
+    for path in paths.values():
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.debug("Failed to drop the cached pages of {}: {}".format(path, e))
+
+    start = time.monotonic()
+    last = -1
+    stable = 0
+    try:
+        while time.monotonic() - start < max_record:
+            time.sleep(sample_interval)
+            samples = {image: resident(path) for image, path in paths.items()}
+            size = sum(length for ranges in samples.values() for _, length in ranges)
+            stable = stable + 1 if size <= last else 0
+            last = max(last, size)
+            if stable >= stable_samples and time.monotonic() - start >= min_record:
+                break
+    except OSError as e:
+        logging.debug("Recording the boot readahead profile failed: {}".format(e))
+        return
+
+    profile = load_profile(args)
+    for image in images:
+        profile[paths[image]] = {"key": keys[image], "ranges": merge(samples[image])}
+    # Profiles of images that were replaced never match again
+    for path in [path for path in profile if not os.path.isfile(path)]:
+        del profile[path]
+    path = profile_path(args)
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(profile, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.debug("Failed to save the boot readahead profile: {}".format(e))
+        return
+    logging.info("Recorded boot readahead profile: {} MB".format(
+        round(sum(length for image in images for _, length in profile[paths[image]]["ranges"]) / 1000000)))
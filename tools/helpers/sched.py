@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import ctypes
+import logging
+import os
+import platform
+import threading
+import tools.config
+from tools.helpers import libc
+from contextlib import contextmanager, suppress
+
+# ioprio_set() and ioprio_get() syscall numbers, there is no libc wrapper
+IOPRIO_SYSCALLS = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "riscv64": (30, 31),
+    "armv7l": (314, 315),
+    "armv8l": (314, 315),
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {
+    "best-effort": IOPRIO_CLASS_BE,
+    "idle": IOPRIO_CLASS_IDLE,
+}
+
+def _ioprio(call, *params):
+    syscalls = IOPRIO_SYSCALLS.get(platform.machine())
+    if syscalls is None:
+        return -1
+    ret = libc.load().syscall(syscalls[call], IOPRIO_WHO_PROCESS, *params)
+    if ret < 0:
+        logging.debug("ioprio syscall failed: " + os.strerror(ctypes.get_errno()))
+    return ret
+
+def get_ioprio(tid=0):
+    """
+    :returns: the raw I/O priority of a thread, -1 on failure
+    """
+    return _ioprio(1, tid)
+
+def set_ioprio(ioclass, level=0, tid=0):
+    """
+    Set the I/O scheduling class of a thread, like ionice(1).
+
+    :param ioclass: IOPRIO_CLASS_BE or IOPRIO_CLASS_IDLE
+    :param level: priority within the class, 0 (highest) to 7
+    :param tid: thread id, 0 for the calling thread
+    :returns: True on success
+    """
+    return _ioprio(0, tid, (ioclass << IOPRIO_CLASS_SHIFT) | level) == 0
+
+@contextmanager
+def background(args):
+    """
+    Run the with block at the CPU and I/O priority configured for background
+    image work (background_nice and background_ioprio), so it doesn't
+    compete with Android. Threads started in the block inherit the
+    priorities. The priorities of the calling thread are restored after.
+    """
+    cfg = tools.config.load(args)
+    tid = threading.get_native_id()
+    old_nice = os.getpriority(os.PRIO_PROCESS, tid)
+    old_ioprio = get_ioprio(tid)
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, int(cfg["waydroid"]["background_nice"]))
+    except (OSError, ValueError) as e:
+        logging.debug("Failed to set the CPU priority: {}".format(e))
+    ioclass = IOPRIO_CLASSES.get(cfg["waydroid"]["background_ioprio"])
+    if ioclass:
+        set_ioprio(ioclass, 7 if ioclass == IOPRIO_CLASS_BE else 0, tid)
+    try:
+        yield
+    finally:
+        # Raising the priority again needs root, which upgrades run as
+        with suppress(OSError):
+            os.setpriority(os.PRIO_PROCESS, tid, old_nice)
+        if ioclass and old_ioprio >= 0:
+            _ioprio(0, tid, old_ioprio)
@@ -31,10 +31,13 @@ def start(args):
         helpers.lxc.start(args)
 
     def upgrade(system_zip, system_time, vendor_zip, vendor_time):
-        helpers.lxc.stop(args)
-        helpers.images.umount_rootfs(args)
-        helpers.images.replace(args, system_zip, system_time,
-                               vendor_zip, vendor_time)
+        args.images_path = tools.config.load(args)["waydroid"]["images_path"]
+        # Wait for a background pre-stage while Android still runs
+        with helpers.images.slot_lock(args):
+            helpers.lxc.stop(args)
+            helpers.images.umount_rootfs(args)
+            helpers.images.replace(args, system_zip, system_time,
+                                   vendor_zip, vendor_time)
         args.session["background_start"] = "false"
         helpers.images.mount_rootfs(args, args.images_path, args.session)
         helpers.protocol.set_aidl_version(args)